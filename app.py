@@ -1,18 +1,39 @@
+import asyncio
+import json
+import logging
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
-from llm_play import LLM_Agent
+from typing import Optional
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import Response, StreamingResponse
+from session_manager import SessionManager, SessionPoolFull
+from metrics import exposition, monitor_event_loop, TrackedExecutor
 from fastapi.middleware.cors import CORSMiddleware
 
-agent = None
+logger = logging.getLogger(__name__)
+
+sessions = None
+# keep references to detached turn tasks so they are not garbage collected
+background_tasks = set()
+
+async def evict_idle_sessions():
+    while True:
+        await asyncio.sleep(60)
+        await sessions.evict_idle()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Initialize LLM agent before serving
-    global agent
-    agent = LLM_Agent()
+    # Initialize the shared resources and the session pool before serving
+    global sessions
+    # embedding batches and env creation run in the default executor, track its saturation
+    asyncio.get_running_loop().set_default_executor(TrackedExecutor())
+    sessions = SessionManager()
+    await sessions.initialize()
+    eviction = asyncio.create_task(evict_idle_sessions())
+    loop_monitor = asyncio.create_task(monitor_event_loop())
     yield
-    # Clean up resources if needed
-    pass
+    loop_monitor.cancel()
+    eviction.cancel()
+    await sessions.close()
 
 app = FastAPI(
     root_path="/",
@@ -32,26 +53,99 @@ app.add_middleware(
 )
 
 
+async def get_session(session_id):
+    try:
+        return await sessions.get(session_id or "default")
+    except SessionPoolFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
 
 @app.post("/chat")
-def chat(user_input: dict):
-    print(user_input)
-    chat_result = agent.main_process(user_input["user_input"])
+async def chat(user_input: dict, x_session_id: Optional[str] = Header(None)):
+    logger.info("chat input of session %s: %s", x_session_id, user_input)
+    session = await get_session(x_session_id)
+    async with session.turn() as agent:
+        chat_result = await agent.main_process(user_input["user_input"])
     return chat_result
 
+@app.post("/chat/stream")
+async def chat_stream(user_input: dict, x_session_id: Optional[str] = Header(None)):
+    '''
+    Same turn as /chat, reported as Server-Sent Events: intent, actions, location,
+    talk, token (dialog deltas), then done with the /chat result or error
+    '''
+    logger.info("chat input of session %s: %s", x_session_id, user_input)
+    session = await get_session(x_session_id)
+    # the session is busy from here, it is not evicted before the turn task takes the lock
+    turn = session.turn()
+    events = asyncio.Queue()
+
+    async def emit(event, data):
+        await events.put((event, data))
+
+    async def run_turn():
+        try:
+            async with turn as agent:
+                chat_result = await agent.main_process(user_input["user_input"], emit=emit)
+            await emit("done", chat_result)
+        except Exception as e:
+            logger.exception("Failed to process the chat turn due to: %s", str(e))
+            await emit("error", {"message": str(e)})
+        finally:
+            await events.put(None)
+
+    # started here rather than in the stream, so the turn runs and frees the session even if the
+    # response is never sent, and keeps running if the client disconnects
+    task = asyncio.create_task(run_turn())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+    async def event_stream():
+        while True:
+            item = await events.get()
+            if item is None:
+                break
+            event, data = item
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/reset")
-def reset():
-    agent.reset_game()
+async def reset(x_session_id: Optional[str] = Header(None)):
+    session = await get_session(x_session_id)
+    async with session.turn() as agent:
+        await agent.reset_game()
     return {"message": "Game reset"}
 
+@app.get("/stats")
+async def stats():
+    return {
+        "sessions": len(sessions.sessions),
+        "embedding_cache": sessions.resources.elasticsearch_memory.embedding_cache.stats(),
+        "embedder": sessions.resources.elasticsearch_memory.embedder.stats(),
+        "intent_classifier": sessions.resources.intent_classifier.stats(),
+        "llm": sessions.resources.llm.stats(),
+        "memory_dedup": sessions.resources.dedup.stats(),
+        "env_pool": sessions.resources.env_pool.stats()
+    }
+
+@app.get("/metrics")
+async def metrics():
+    body, content_type = exposition()
+    return Response(content=body, media_type=content_type)
+
 @app.get("/check_inventory")
-def check_inventory():
-    return {"inventory": agent.get_current_inventory()}
+async def check_inventory(x_session_id: Optional[str] = Header(None)):
+    return {"inventory": (await get_session(x_session_id)).agent.get_current_inventory()}
 
 @app.get("/check_location")
-def check_location():
-    return {"location": agent.get_current_location()}
+async def check_location(x_session_id: Optional[str] = Header(None)):
+    return {"location": (await get_session(x_session_id)).agent.get_current_location()}
 
 @app.get("/check_obs")
-def check_obs():
-    return {"obs": agent.get_current_obs()}
\ No newline at end of file
+async def check_obs(x_session_id: Optional[str] = Header(None)):
+    return {"obs": (await get_session(x_session_id)).agent.get_current_obs()}
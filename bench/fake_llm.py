@@ -0,0 +1,226 @@
+import argparse
+import asyncio
+import copy
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+from prompts import (
+    INITIAL_PROCESS, MAKE_ACTION, GET_MEMORY, CREATE_MEMORY, MERGE_MEMORY,
+    GENERATE_DIALOG, ALEX_NPC, NPC_PROMPTS, SUMMARIZE_HISTORY, REASONING_FORMAT
+)
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "responses.json")
+
+# the stage of a request is recognized by its static system prompt
+STAGE_PROMPTS = [
+    ("initial_process", INITIAL_PROCESS.static),
+    ("make_action", MAKE_ACTION.static),
+    ("get_memory", GET_MEMORY.static),
+    ("create_memory", CREATE_MEMORY.static),
+    ("merge_memory", MERGE_MEMORY.static),
+    ("generate_dialog", GENERATE_DIALOG.static),
+    ("get_Alex_npc", ALEX_NPC.static),
+    ("summarize_history", SUMMARIZE_HISTORY.static),
+] + [("npc_talk", template.static) for template in NPC_PROMPTS.values()]
+
+# label the agent puts in front of the player's text in the user message
+INPUT_LABEL = re.compile(r"^(Player input|Here is the user's input|Here is the command explanation|user): ")
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def substitute(value, player_input):
+    '''
+    Replace {input} in the strings of a canned reply by the player input
+    '''
+    if isinstance(value, str):
+        return value.replace("{input}", player_input)
+    if isinstance(value, list):
+        return [substitute(item, player_input) for item in value]
+    if isinstance(value, dict):
+        return {key: substitute(item, player_input) for key, item in value.items()}
+    return value
+
+
+class FakeLLM:
+    '''
+    Canned chat completions for the agent's stages.
+
+    fixtures (see fixtures/responses.json):
+      latency_ms: stage (or "default") -> {"mean", "jitter"}, the normal delay before a reply,
+        multiplied by latency_scale (0 measures the agent's own overhead)
+      token_ms: delay between two streamed chunks
+      responses: stage -> candidate replies, the first one whose "input" equals the player input
+        (recorded replies) or whose "when" words appear in it wins, otherwise the candidates
+        without a condition are served in turn. A "content" object is sent as JSON.
+    '''
+    def __init__(self, fixtures, seed=0, latency_scale=1.0):
+        self.latency = fixtures.get("latency_ms", {})
+        self.latency_scale = latency_scale
+        self.token_ms = fixtures.get("token_ms", 0)
+        self.responses = fixtures["responses"]
+        self.random = random.Random(seed)
+        self.turns = defaultdict(int)
+        self.requests = Counter()
+
+    def stage(self, messages):
+        system = messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+        for stage, prompt in STAGE_PROMPTS:
+            if system.startswith(prompt):
+                return stage, system.endswith(REASONING_FORMAT)
+        return "unknown", False
+
+    def delay(self, stage):
+        latency = self.latency.get(stage, self.latency.get("default", {}))
+        seconds = self.random.gauss(latency.get("mean", 0), latency.get("jitter", 0)) / 1000
+        return max(0.0, seconds * self.latency_scale)
+
+    def reply(self, stage, player_input, reasoning=False):
+        candidates = self.responses.get(stage) or [{"content": ""}]
+        lowered = player_input.lower()
+        chosen = None
+        for candidate in candidates:
+            if candidate.get("input") == player_input:
+                chosen = candidate
+                break
+            if "when" in candidate and any(word in lowered for word in candidate["when"]):
+                chosen = candidate
+                break
+        if chosen is None:
+            fallback = [candidate for candidate in candidates if "input" not in candidate and "when" not in candidate]
+            fallback = fallback or candidates
+            chosen = fallback[self.turns[stage] % len(fallback)]
+            self.turns[stage] += 1
+        content = substitute(copy.deepcopy(chosen["content"]), player_input)
+        if reasoning:
+            content = {"reasoning": ["canned reply"], "answer": content}
+        return content if isinstance(content, str) else json.dumps(content)
+
+    async def complete(self, body):
+        messages = body.get("messages", [])
+        stage, reasoning = self.stage(messages)
+        self.requests[stage] += 1
+        user = next((message["content"] for message in reversed(messages) if message["role"] == "user"), "")
+        # first line of the last user message, without the label the prompt puts in front of it
+        player_input = INPUT_LABEL.sub("", user.split("\n", 1)[0])[:200]
+        content = self.reply(stage, player_input, reasoning)
+        prompt_tokens = sum(estimate_tokens(str(message.get("content", ""))) for message in messages)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": estimate_tokens(content),
+            "total_tokens": prompt_tokens + estimate_tokens(content),
+            "prompt_tokens_details": {"cached_tokens": 0}
+        }
+        await asyncio.sleep(self.delay(stage))
+        return content, usage
+
+    def stats(self):
+        return dict(self.requests)
+
+
+def completion(model, content, usage):
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": usage
+    }
+
+
+def chunk(id, model, delta=None, finish_reason=None, usage=None):
+    choices = [] if usage is not None else [{"index": 0, "delta": delta or {}, "finish_reason": finish_reason}]
+    return {
+        "id": id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": choices,
+        "usage": usage
+    }
+
+
+def create_app(fake):
+    app = FastAPI()
+
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get("model", "fake")
+        content, usage = await fake.complete(body)
+        if not body.get("stream"):
+            return completion(model, content, usage)
+
+        async def events():
+            id = f"chatcmpl-{uuid.uuid4().hex}"
+            words = content.split(" ")
+            for i, word in enumerate(words):
+                delta = {"content": word if i == 0 else " " + word}
+                if i == 0:
+                    delta["role"] = "assistant"
+                yield f"data: {json.dumps(chunk(id, model, delta))}\n\n"
+                await asyncio.sleep(fake.token_ms * fake.latency_scale / 1000)
+            yield f"data: {json.dumps(chunk(id, model, finish_reason='stop'))}\n\n"
+            if body.get("stream_options", {}).get("include_usage"):
+                yield f"data: {json.dumps(chunk(id, model, usage=usage))}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    # OpenAI clients post to {base_url}/chat/completions, with or without a /v1 suffix
+    app.post("/v1/chat/completions")(chat_completions)
+    app.post("/chat/completions")(chat_completions)
+    app.get("/stats")(fake.stats)
+    return app
+
+
+def load_fixtures(path=DEFAULT_FIXTURES):
+    with open(path) as f:
+        return json.load(f)
+
+
+def serve_in_thread(fake, host="127.0.0.1", port=8001):
+    '''
+    Run the fake server on its own event loop in a daemon thread, so its latency does not
+    compete with the agent's loop. Returns the uvicorn server, set should_exit to stop it.
+    '''
+    server = uvicorn.Server(uvicorn.Config(create_app(fake), host=host, port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError(f"the fake LLM server could not start on {host}:{port}")
+        time.sleep(0.05)
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI-compatible server returning canned replies for the agent's stages")
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURES)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency-scale", type=float, default=1.0)
+    args = parser.parse_args()
+    fake = FakeLLM(load_fixtures(args.fixtures), seed=args.seed, latency_scale=args.latency_scale)
+    uvicorn.run(create_app(fake), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,396 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+import httpx
+from prometheus_client.parser import text_string_to_metric_families
+
+from bench.replay import load_scripts, percentile, git_commit, DEFAULT_SESSIONS, RESULTS_DIR
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+ENDPOINTS = {
+    "chat": ("POST", "/chat"),
+    "check_location": ("GET", "/check_location"),
+    "check_inventory": ("GET", "/check_inventory"),
+    "check_obs": ("GET", "/check_obs"),
+    "reset": ("POST", "/reset"),
+}
+
+# request mix of a player and the mean of its exponentially distributed think time.
+# Every player posts /reset and starts its script over once it has sent all of it.
+PROFILES = {
+    "player": {"weights": {"chat": 0.7, "check_location": 0.1, "check_inventory": 0.1, "check_obs": 0.1}, "think_seconds": 5.0},
+    "explorer": {"weights": {"chat": 0.3, "check_location": 0.3, "check_inventory": 0.3, "check_obs": 0.1}, "think_seconds": 3.0},
+    "spammer": {"weights": {"chat": 0.9, "check_location": 0.05, "check_inventory": 0.05}, "think_seconds": 0.5},
+}
+
+
+def parse_weights(text):
+    '''
+    "player=0.8,spammer=0.2" -> {"player": 0.8, "spammer": 0.2}
+    '''
+    weights = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def flatten_metrics(text):
+    '''
+    Prometheus exposition -> sample name -> value summed over the labels
+    '''
+    values = defaultdict(float)
+    for family in text_string_to_metric_families(text):
+        for sample in family.samples:
+            values[sample.name] += sample.value
+    return dict(values)
+
+
+def latency_stats(samples):
+    if not samples:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+    return {
+        "p50_ms": round(1000 * percentile(samples, 0.5), 1),
+        "p95_ms": round(1000 * percentile(samples, 0.95), 1),
+        "p99_ms": round(1000 * percentile(samples, 0.99), 1),
+    }
+
+
+class LoadTest:
+    '''
+    Ramps a population of simulated players against a running app.
+
+    Players are added at every step of the ramp and keep playing until the end, each one
+    under its own session id. /metrics and /stats are scraped during every step to tell
+    where the server saturates: default executor queue, encoder busy time, ES latency,
+    event loop lag.
+    '''
+    def __init__(self, client, scripts, population, think_scale=1.0, seed=0):
+        self.client = client
+        self.scripts = list(scripts.values())
+        self.population = population
+        self.think_scale = think_scale
+        self.random = random.Random(seed)
+        self.seed = seed
+        self.run_id = f"{int(time.time())}"
+        self.step = 0
+        self.players = []
+        self.profiles = Counter()
+        # (step, endpoint, status, seconds)
+        self.results = []
+        # (step, monotonic time, flattened metrics, stats)
+        self.snapshots = []
+
+    async def request(self, session_id, endpoint, payload=None):
+        method, path = ENDPOINTS[endpoint]
+        step = self.step
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, path, json=payload, headers={"X-Session-Id": session_id})
+            status = response.status_code
+        except httpx.TimeoutException:
+            status = "timeout"
+        except httpx.HTTPError as e:
+            logger.warning("%s for %s failed: %s", endpoint, session_id, str(e))
+            status = "error"
+        self.results.append((step, endpoint, status, time.perf_counter() - started))
+
+    async def player(self, index, profile):
+        session_id = f"load-{self.run_id}-{index}"
+        rng = random.Random(self.seed + index)
+        script = self.scripts[index % len(self.scripts)]
+        endpoints = list(profile["weights"])
+        weights = list(profile["weights"].values())
+        position = 0
+        while True:
+            endpoint = rng.choices(endpoints, weights)[0]
+            if endpoint == "chat":
+                await self.request(session_id, "chat", {"user_input": script[position]})
+                position += 1
+                if position == len(script):
+                    await self.request(session_id, "reset")
+                    position = 0
+            else:
+                await self.request(session_id, endpoint)
+            think = profile["think_seconds"] * self.think_scale
+            if think > 0:
+                await asyncio.sleep(rng.expovariate(1 / think))
+
+    async def scrape(self):
+        try:
+            metrics = await self.client.get("/metrics")
+            stats = await self.client.get("/stats")
+            self.snapshots.append((self.step, time.monotonic(), flatten_metrics(metrics.text), stats.json()))
+        except (httpx.HTTPError, ValueError) as e:
+            logger.warning("scrape failed: %s", str(e))
+
+    async def monitor(self, interval):
+        while True:
+            await self.scrape()
+            await asyncio.sleep(interval)
+
+    def add_players(self, count):
+        names = list(self.population)
+        weights = list(self.population.values())
+        while len(self.players) < count:
+            name = self.random.choices(names, weights)[0]
+            self.profiles[name] += 1
+            self.players.append(asyncio.create_task(self.player(len(self.players), PROFILES[name])))
+
+    async def run(self, ramp, step_seconds, scrape_interval):
+        monitor = asyncio.create_task(self.monitor(scrape_interval))
+        try:
+            for step, count in enumerate(ramp):
+                self.step = step
+                await self.scrape()
+                self.add_players(count)
+                logger.info("step %d: %d players", step, count)
+                await asyncio.sleep(step_seconds)
+            self.step = len(ramp)
+            await self.scrape()
+        finally:
+            monitor.cancel()
+            for task in self.players:
+                task.cancel()
+            await asyncio.gather(monitor, *self.players, return_exceptions=True)
+
+    def server_stats(self, step):
+        '''
+        Server side signals of a step: rates from the first and last scrape, maxima of the gauges
+        '''
+        # the scrape opening the next step closes this one
+        snapshots = [s for s in self.snapshots if s[0] == step]
+        snapshots += [s for s in self.snapshots if s[0] == step + 1][:1]
+        if len(snapshots) < 2:
+            return {}
+        (_, start, first, _), (_, end, last, last_stats) = snapshots[0], snapshots[-1]
+        elapsed = end - start
+
+        def delta(name):
+            if name not in last or name not in first:
+                return None
+            return last[name] - first[name]
+
+        def rate(name):
+            value = delta(name)
+            return round(value / elapsed, 3) if value is not None and elapsed else None
+
+        def peak(name, scale=1.0):
+            values = [metrics[name] for _, _, metrics, _ in snapshots if name in metrics]
+            return round(max(values) * scale, 1) if values else None
+
+        def busy_share(name):
+            # share of the scrapes that found the gauge above 0, a single spike is not a backlog
+            values = [metrics[name] for _, _, metrics, _ in snapshots if name in metrics]
+            return round(sum(1 for value in values if value > 0) / len(values), 2) if values else None
+
+        es_count = delta("es_request_seconds_count")
+        return {
+            "cpu_utilization": rate("process_cpu_seconds_total"),
+            "encoder_utilization": rate("embed_batch_seconds_sum"),
+            "es_mean_ms": round(1000 * delta("es_request_seconds_sum") / es_count, 1) if es_count else None,
+            "es_requests_per_s": rate("es_request_seconds_count"),
+            "threadpool_workers": peak("threadpool_workers"),
+            "threadpool_active_max": peak("threadpool_active"),
+            "threadpool_queued_max": peak("threadpool_queued"),
+            "threadpool_queued_share": busy_share("threadpool_queued"),
+            "event_loop_lag_max_ms": peak("event_loop_lag_seconds", 1000),
+            "embed_queue_max": max(stats.get("embedder", {}).get("queued", 0) for _, _, _, stats in snapshots),
+            "sessions": last_stats.get("sessions"),
+        }
+
+    def report(self, ramp, step_seconds, thresholds):
+        steps = []
+        for step, players in enumerate(ramp):
+            results = [r for r in self.results if r[0] == step]
+            endpoints = {}
+            for endpoint in ENDPOINTS:
+                latencies = [seconds for _, name, status, seconds in results if name == endpoint and status == 200]
+                failed = sum(1 for _, name, status, _ in results if name == endpoint and status != 200)
+                if latencies or failed:
+                    endpoints[endpoint] = dict(count=len(latencies) + failed, errors=failed, **latency_stats(latencies))
+            ok = sum(1 for r in results if r[2] == 200)
+            steps.append({
+                "players": players,
+                "requests": len(results),
+                "throughput_rps": round(ok / step_seconds, 3),
+                "chat_turns_per_s": round(sum(1 for r in results if r[1] == "chat" and r[2] == 200) / step_seconds, 3),
+                "error_rate": round((len(results) - ok) / len(results), 4) if results else 0.0,
+                "errors": dict(Counter(str(r[2]) for r in results if r[2] != 200)),
+                "endpoints": endpoints,
+                "server": self.server_stats(step),
+            })
+        # the first step that has the measurement, ES is not hit before the first memory lookup
+        baseline = {
+            "es_mean_ms": next((step["server"].get("es_mean_ms") for step in steps if step["server"].get("es_mean_ms")), None),
+            "chat_p95_ms": next((step["endpoints"]["chat"]["p95_ms"] for step in steps
+                                 if step["endpoints"].get("chat", {}).get("p95_ms")), None),
+        }
+        for i, step in enumerate(steps):
+            step["saturated"] = saturation_reasons(step, baseline, steps[i - 1] if i else None, thresholds)
+        saturated = next((step for step in steps if step["saturated"]), None)
+        healthy = [step["players"] for step in steps if not step["saturated"]]
+        return {
+            "commit": git_commit(),
+            "date": datetime.utcnow().isoformat() + "Z",
+            "target": str(self.client.base_url),
+            "ramp": ramp,
+            "step_seconds": step_seconds,
+            "population": dict(self.profiles),
+            "think_scale": self.think_scale,
+            "steps": steps,
+            "saturation": {"players": saturated["players"], "reasons": saturated["saturated"]} if saturated else None,
+            "max_healthy_players": max(healthy) if healthy else None,
+        }
+
+
+def saturation_reasons(step, baseline, previous, thresholds):
+    '''
+    Why a step of the ramp counts as saturated, empty if it does not
+    baseline: ES mean latency and chat p95 of the first steps, the slowdowns are relative to them
+    '''
+    reasons = []
+    server = step["server"]
+    if step["error_rate"] > thresholds["error_rate"]:
+        reasons.append(f"error rate {step['error_rate']:.1%} {step['errors']}")
+    if (server.get("threadpool_queued_share") or 0) >= thresholds["queued_share"]:
+        reasons.append(
+            f"threadpool exhausted, jobs waiting in {server['threadpool_queued_share']:.0%} of the scrapes "
+            f"(up to {server['threadpool_queued_max']:.0f})"
+        )
+    if (server.get("encoder_utilization") or 0) >= thresholds["encoder_utilization"]:
+        reasons.append(f"encoder busy {server['encoder_utilization']:.0%} of the time")
+    if (server.get("event_loop_lag_max_ms") or 0) > thresholds["event_loop_lag_ms"]:
+        reasons.append(f"event loop lag up to {server['event_loop_lag_max_ms']}ms")
+    es_baseline = baseline["es_mean_ms"]
+    if es_baseline and (server.get("es_mean_ms") or 0) > thresholds["slowdown"] * es_baseline:
+        reasons.append(f"ES latency {server['es_mean_ms']}ms, {server['es_mean_ms'] / es_baseline:.1f}x the baseline")
+    chat_baseline = baseline["chat_p95_ms"]
+    current = step["endpoints"].get("chat", {}).get("p95_ms")
+    if chat_baseline and current and current > thresholds["slowdown"] * chat_baseline:
+        reasons.append(f"chat p95 {current}ms, {current / chat_baseline:.1f}x the baseline")
+    if previous is not None and step["players"] > previous["players"] and previous["chat_turns_per_s"]:
+        if step["chat_turns_per_s"] < 1.1 * previous["chat_turns_per_s"]:
+            reasons.append(f"throughput plateau at {step['chat_turns_per_s']} chat turns/s")
+    return reasons
+
+
+def print_report(report):
+    print(f"{report['target']}, population {report['population']}, {report['step_seconds']}s per step")
+    print(f"{'players':>8}{'req/s':>9}{'chat/s':>9}{'errors':>8}{'chat p95':>10}{'ES ms':>8}{'encoder':>9}{'queued':>8}{'lag ms':>8}")
+    for step in report["steps"]:
+        server = step["server"]
+        chat = step["endpoints"].get("chat", {})
+        print(f"{step['players']:>8}{step['throughput_rps']:>9}{step['chat_turns_per_s']:>9}{step['error_rate']:>8.1%}"
+              f"{str(chat.get('p95_ms')):>10}{str(server.get('es_mean_ms')):>8}{str(server.get('encoder_utilization')):>9}"
+              f"{str(server.get('threadpool_queued_max')):>8}{str(server.get('event_loop_lag_max_ms')):>8}")
+    if report["saturation"]:
+        print(f"saturated at {report['saturation']['players']} players: {'; '.join(report['saturation']['reasons'])}")
+    else:
+        print("no saturation within the ramp")
+
+
+def compare(base, head, threshold=0.10):
+    '''
+    Scaling regressions of head against base: an earlier saturation point, and a lower chat
+    throughput or a higher chat p95 at the same number of players
+    '''
+    regressions = []
+    base_max, head_max = base.get("max_healthy_players") or 0, head.get("max_healthy_players") or 0
+    if head_max < base_max:
+        regressions.append(f"max healthy players: {base_max} -> {head_max}")
+    base_steps = {step["players"]: step for step in base["steps"]}
+    for step in head["steps"]:
+        before = base_steps.get(step["players"])
+        if before is None:
+            continue
+        if before["chat_turns_per_s"] and step["chat_turns_per_s"] < (1 - threshold) * before["chat_turns_per_s"]:
+            regressions.append(f"{step['players']} players: chat turns/s {before['chat_turns_per_s']} -> {step['chat_turns_per_s']}")
+        p95_before = before["endpoints"].get("chat", {}).get("p95_ms")
+        p95 = step["endpoints"].get("chat", {}).get("p95_ms")
+        if p95_before and p95 and p95 > (1 + threshold) * p95_before:
+            regressions.append(f"{step['players']} players: chat p95 {p95_before}ms -> {p95}ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ramp simulated players against the app and find where it saturates")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="run a ramp and write a report")
+    run.add_argument("--url", default="http://localhost:8000")
+    run.add_argument("--ramp", default="1,5,10,20,50", help="players at every step")
+    run.add_argument("--step-seconds", type=float, default=60)
+    run.add_argument("--population", default="player=0.7,explorer=0.2,spammer=0.1",
+                     help=f"profile=weight among {', '.join(PROFILES)}")
+    run.add_argument("--think-scale", type=float, default=1.0, help="multiplies the think times of the profiles")
+    run.add_argument("--sessions", default=DEFAULT_SESSIONS, help="JSONL script or llm_play.log the chat inputs come from")
+    run.add_argument("--timeout", type=float, default=120)
+    run.add_argument("--scrape-interval", type=float, default=2)
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--max-error-rate", type=float, default=0.01)
+    run.add_argument("--max-encoder-utilization", type=float, default=0.9)
+    run.add_argument("--max-queued-share", type=float, default=0.5,
+                     help="share of the scrapes of a step that may find jobs waiting for the threadpool")
+    run.add_argument("--max-loop-lag-ms", type=float, default=100)
+    run.add_argument("--max-slowdown", type=float, default=2.0, help="chat p95 / ES latency growth over the first step")
+    run.add_argument("--output", help="report path, bench/results/load-<time>.json by default")
+    diff = commands.add_parser("compare", help="report the scaling regressions of a report against a baseline")
+    diff.add_argument("base")
+    diff.add_argument("head")
+    diff.add_argument("--threshold", type=float, default=0.10)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if args.command == "compare":
+        with open(args.base) as f:
+            base = json.load(f)
+        with open(args.head) as f:
+            head = json.load(f)
+        regressions = compare(base, head, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if not regressions:
+            print(f"no scaling regression between {base['commit']} and {head['commit']}")
+        sys.exit(1 if regressions else 0)
+
+    population = parse_weights(args.population)
+    unknown = set(population) - set(PROFILES)
+    if unknown:
+        parser.error(f"unknown profiles: {', '.join(sorted(unknown))}")
+    ramp = [int(players) for players in args.ramp.split(",")]
+    thresholds = {
+        "error_rate": args.max_error_rate,
+        "encoder_utilization": args.max_encoder_utilization,
+        "queued_share": args.max_queued_share,
+        "event_loop_lag_ms": args.max_loop_lag_ms,
+        "slowdown": args.max_slowdown,
+    }
+
+    async def run_load():
+        limits = httpx.Limits(max_connections=max(ramp) + 2, max_keepalive_connections=max(ramp) + 2)
+        async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+            load = LoadTest(client, load_scripts(args.sessions), population, args.think_scale, args.seed)
+            await load.run(ramp, args.step_seconds, args.scrape_interval)
+            return load.report(ramp, args.step_seconds, thresholds)
+
+    report = asyncio.run(run_load())
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    output = args.output or os.path.join(RESULTS_DIR, f"load-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=4)
+    print_report(report)
+    print(f"report written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import re
+import uuid
+from collections import Counter
+
+import numpy as np
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+TOKEN = re.compile(r"\w+")
+
+
+def tokens(value):
+    if isinstance(value, list):
+        return [token for item in value for token in tokens(item)]
+    return TOKEN.findall(str(value).lower())
+
+
+class InMemoryIndices:
+    def __init__(self, es):
+        self.es = es
+
+    async def exists(self, index):
+        return index in self.es.indices_created
+
+    async def create(self, index, body=None):
+        self.es.indices_created.add(index)
+        self.es.docs.setdefault(index, {})
+
+    async def put_mapping(self, index, properties=None):
+        pass
+
+
+class InMemoryElasticsearch:
+    '''
+    Stand-in for the AsyncElasticsearch client of ElasticsearchMemory, keeping the documents in a dict.
+
+    Only the subset of the query DSL the agent sends is understood: bool (must / filter / should),
+    term, terms, multi_match and a top level knn clause (exact cosine search, scored (1 + cosine) / 2
+    like a cosine dense_vector) whose score is added to the lexical one, plus a sort on one field.
+    multi_match is a term overlap score, good enough to rank a few hundred memories, not BM25.
+    Writes are visible immediately whatever the refresh policy.
+    '''
+    def __init__(self):
+        self.docs = {}
+        self.indices_created = set()
+        self.indices = InMemoryIndices(self)
+        self.requests = Counter()
+
+    def _index(self, index):
+        return self.docs.setdefault(index, {})
+
+    def _matches(self, doc, clause):
+        if "term" in clause:
+            (field, value), = clause["term"].items()
+            value = value.get("value") if isinstance(value, dict) else value
+            current = doc.get(field)
+            return value in current if isinstance(current, list) else current == value
+        if "terms" in clause:
+            (field, values), = clause["terms"].items()
+            current = doc.get(field)
+            current = current if isinstance(current, list) else [current]
+            return any(value in current for value in values)
+        if "bool" in clause:
+            return self._bool_score(doc, clause["bool"]) is not None
+        if "multi_match" in clause:
+            return self._text_score(doc, clause["multi_match"]) > 0
+        if "match_all" in clause:
+            return True
+        raise ValueError(f"unsupported query clause: {list(clause)}")
+
+    def _text_score(self, doc, multi_match):
+        query = set(tokens(multi_match["query"]))
+        score = 0.0
+        for field in multi_match.get("fields", []):
+            name, _, boost = field.partition("^")
+            if name in doc:
+                score += float(boost or 1) * sum(1 for token in tokens(doc[name]) if token in query)
+        return score
+
+    def _clause_score(self, doc, clause):
+        if "multi_match" in clause:
+            score = self._text_score(doc, clause["multi_match"])
+            return score if score > 0 else None
+        if "bool" in clause:
+            return self._bool_score(doc, clause["bool"])
+        return 1.0 if self._matches(doc, clause) else None
+
+    def _bool_score(self, doc, query):
+        '''
+        Score of doc for a bool query, None if it does not match
+        '''
+        if not all(self._matches(doc, clause) for clause in query.get("filter", [])):
+            return None
+        score = 0.0
+        for clause in query.get("must", []):
+            clause_score = self._clause_score(doc, clause)
+            if clause_score is None:
+                return None
+            score += clause_score
+        should = [self._clause_score(doc, clause) for clause in query.get("should", [])]
+        matched = [clause_score for clause_score in should if clause_score is not None]
+        if should and not matched and not query.get("must") and not query.get("filter"):
+            # a bool query with only should clauses needs at least one of them
+            return None
+        return score + sum(matched)
+
+    def _knn(self, docs, knn):
+        query = np.asarray(knn["query_vector"], dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        scored = []
+        for id, doc in docs.items():
+            if not all(self._matches(doc, clause) for clause in knn.get("filter", [])):
+                continue
+            vector = np.asarray(doc["embedding"], dtype=np.float32)
+            cosine = float(vector @ query) / (float(np.linalg.norm(vector)) or 1.0)
+            scored.append((id, (1 + cosine) / 2))
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return dict(scored[:knn.get("k", 10)])
+
+    def _search(self, index, body):
+        docs = self._index(index)
+        scores = {}
+        if "knn" in body:
+            scores.update(self._knn(docs, body["knn"]))
+        if "query" in body:
+            for id, doc in docs.items():
+                score = self._clause_score(doc, body["query"])
+                if score is not None:
+                    scores[id] = scores.get(id, 0.0) + score
+        elif "knn" not in body:
+            scores = {id: 1.0 for id in docs}
+        ids = sorted(scores, key=scores.get, reverse=True)
+        for sort in reversed(body.get("sort", [])):
+            (field, order), = sort.items()
+            reverse = (order.get("order", "asc") if isinstance(order, dict) else order) == "desc"
+            ids.sort(key=lambda id: docs[id].get(field) or "", reverse=reverse)
+        hits = [
+            {"_index": index, "_id": id, "_score": scores[id], "_source": docs[id]}
+            for id in ids[:body.get("size", 10)]
+        ]
+        return {"hits": {"total": {"value": len(scores), "relation": "eq"}, "hits": hits}}
+
+    async def search(self, index, body=None, **kwargs):
+        self.requests["search"] += 1
+        return self._search(index, dict(body or {}, **kwargs))
+
+    async def msearch(self, searches):
+        self.requests["msearch"] += 1
+        return {"responses": [
+            self._search(header["index"], body) for header, body in zip(searches[::2], searches[1::2])
+        ]}
+
+    async def index(self, index, body=None, document=None, id=None, refresh=None):
+        self.requests["index"] += 1
+        id = id or uuid.uuid4().hex
+        self._index(index)[id] = dict(body or document)
+        return {"_index": index, "_id": id, "result": "created"}
+
+    async def delete(self, index, id, **kwargs):
+        self.requests["delete"] += 1
+        found = self._index(index).pop(id, None) is not None
+        return {"_index": index, "_id": id, "result": "deleted" if found else "not_found"}
+
+    async def delete_by_query(self, index, query, **kwargs):
+        self.requests["delete_by_query"] += 1
+        docs = self._index(index)
+        ids = [id for id, doc in docs.items() if self._matches(doc, query)]
+        for id in ids:
+            del docs[id]
+        return {"deleted": len(ids)}
+
+    async def bulk(self, operations, refresh=None):
+        self.requests["bulk"] += 1
+        items = []
+        operations = list(operations)
+        i = 0
+        while i < len(operations):
+            (action, meta), = operations[i].items()
+            docs = self._index(meta["_index"])
+            id = meta.get("_id")
+            if action == "delete":
+                found = docs.pop(id, None) is not None
+                items.append({"delete": {"_id": id, "result": "deleted" if found else "not_found"}})
+                i += 1
+                continue
+            source = operations[i + 1]
+            i += 2
+            if action == "update":
+                if id not in docs:
+                    items.append({"update": {"_id": id, "status": 404, "error": {"type": "document_missing_exception"}}})
+                    continue
+                docs[id].update(source["doc"])
+                items.append({"update": {"_id": id, "result": "updated"}})
+            else:
+                id = id or uuid.uuid4().hex
+                docs[id] = dict(source)
+                items.append({action: {"_id": id, "result": "created"}})
+        return {"errors": any(list(item.values())[0].get("error") for item in items), "items": items}
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {
+            "documents": {index: len(docs) for index, docs in self.docs.items()},
+            "requests": dict(self.requests)
+        }
@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import httpx
+
+from bench.fake_llm import FakeLLM, load_fixtures, serve_in_thread, DEFAULT_FIXTURES
+from bench.memory_es import InMemoryElasticsearch
+from intent_classifier import USER_INPUT_LINE
+from log_config import read_messages, setup_logging
+from metrics import turn_spans
+
+logger = logging.getLogger(__name__)
+
+BENCH_DIR = os.path.dirname(__file__)
+DEFAULT_SESSIONS = os.path.join(BENCH_DIR, "fixtures", "sessions.jsonl")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+
+def load_scripts(path):
+    '''
+    Scripted player sessions: session id -> list of player inputs, read from a JSONL file of
+    {"session", "user_input"} lines or from the user inputs logged in llm_play.log
+    '''
+    scripts = defaultdict(list)
+    if path.endswith(".jsonl"):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    turn = json.loads(line)
+                    scripts[turn.get("session", "bench")].append(turn["user_input"])
+    else:
+        for message in read_messages(path):
+            match = USER_INPUT_LINE.search(message)
+            if match:
+                scripts["log"].append(match.group(1))
+    return dict(scripts)
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(durations):
+    '''
+    stage -> {count, mean, p50, p95, p99} in milliseconds
+    '''
+    return {
+        stage: {
+            "count": len(samples),
+            "mean_ms": round(1000 * sum(samples) / len(samples), 1),
+            "p50_ms": round(1000 * percentile(samples, 0.5), 1),
+            "p95_ms": round(1000 * percentile(samples, 0.95), 1),
+            "p99_ms": round(1000 * percentile(samples, 0.99), 1),
+        }
+        for stage, samples in sorted(durations.items())
+    }
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + "-dirty" if dirty else commit
+
+
+class Replay:
+    '''
+    Replays the scripted sessions against the agent, either calling LLM_Agent.main_process
+    directly (mode "agent") or posting to /chat of the FastAPI app in process (mode "app").
+    Every player runs its script turn after turn, players run concurrently.
+    '''
+    def __init__(self, resources, mode="agent"):
+        self.resources = resources
+        self.mode = mode
+        self.turn_seconds = []
+        self.errors = 0
+        self.agents = []
+
+    async def play_agent(self, session_id, inputs):
+        from llm_play import LLM_Agent
+        agent = LLM_Agent(self.resources, session_id, ready_env=await self.resources.env_pool.acquire())
+        self.agents.append(agent)
+        await agent.forget()
+        for user_input in inputs:
+            await self.timed(agent.main_process(user_input))
+
+    async def play_app(self, client, session_id, inputs):
+        for user_input in inputs:
+            await self.timed(client.post("/chat", json={"user_input": user_input}, headers={"X-Session-Id": session_id}))
+
+    async def timed(self, call):
+        started = time.perf_counter()
+        try:
+            result = await call
+            if isinstance(result, httpx.Response):
+                result.raise_for_status()
+        except Exception as e:
+            self.errors += 1
+            logger.exception("turn failed: %s", str(e))
+            return
+        self.turn_seconds.append(time.perf_counter() - started)
+
+    async def run(self, players):
+        '''
+        players: session id -> inputs
+        '''
+        if self.mode == "agent":
+            await asyncio.gather(*(self.play_agent(session_id, inputs) for session_id, inputs in players.items()))
+            return
+        import app as app_module
+        from session_manager import SessionManager
+        app_module.sessions = SessionManager(self.resources, max_sessions=len(players))
+        transport = httpx.ASGITransport(app=app_module.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            await asyncio.gather(*(self.play_app(client, session_id, inputs) for session_id, inputs in players.items()))
+        self.agents.extend(session.agent for session in app_module.sessions.sessions.values())
+
+    def close(self):
+        for agent in self.agents:
+            agent.close()
+
+
+async def run_benchmark(args, fake, es):
+    from llm_play import AgentResources
+    scripts = load_scripts(args.sessions)
+    # every player plays every script under its own session id
+    players = {
+        f"{session_id}-p{player}": inputs
+        for player in range(args.players)
+        for session_id, inputs in scripts.items()
+    }
+    resources = AgentResources(es=es)
+    replay = Replay(resources, args.mode)
+    # memory writer, embedder and history tasks are started under this collection, so their spans land in it too
+    with turn_spans() as spans:
+        await resources.initialize()
+        started = time.perf_counter()
+        await replay.run(players)
+        wall = time.perf_counter() - started
+        # memories are written behind the turns, wait for them before reading the spans
+        await resources.memory_writer.queue.join()
+    replay.close()
+    await resources.close()
+
+    durations = defaultdict(list)
+    for stage, elapsed in spans:
+        durations[stage].append(elapsed)
+    durations["turn"] = replay.turn_seconds
+    return {
+        "commit": git_commit(),
+        "date": datetime.utcnow().isoformat() + "Z",
+        "mode": args.mode,
+        "players": len(players),
+        "latency_scale": args.latency_scale,
+        "turns": len(replay.turn_seconds),
+        "errors": replay.errors,
+        "wall_seconds": round(wall, 3),
+        "throughput_turns_per_s": round(len(replay.turn_seconds) / wall, 3) if wall else 0.0,
+        "stages": summarize({stage: samples for stage, samples in durations.items() if samples}),
+        "llm_requests": fake.stats(),
+        "es": es.stats()
+    }
+
+
+def print_report(report):
+    print(f"commit {report['commit']}, mode {report['mode']}, {report['players']} players, "
+          f"{report['turns']} turns ({report['errors']} errors) in {report['wall_seconds']}s, "
+          f"{report['throughput_turns_per_s']} turns/s")
+    print(f"{'stage':<28}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<28}{stats['count']:>7}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+
+
+def compare(base, head, metric="p95_ms", threshold=0.10):
+    '''
+    Regressions of head against base: stages whose metric grew by more than threshold, and a
+    throughput drop of more than threshold. Returns the list of messages, empty if none.
+    '''
+    regressions = []
+    for stage, stats in head["stages"].items():
+        before = base["stages"].get(stage)
+        if before is None or not before[metric]:
+            continue
+        change = stats[metric] / before[metric] - 1
+        if change > threshold:
+            regressions.append(f"{stage} {metric}: {before[metric]} -> {stats[metric]} (+{change:.0%})")
+    if base["throughput_turns_per_s"]:
+        change = head["throughput_turns_per_s"] / base["throughput_turns_per_s"] - 1
+        if change < -threshold:
+            regressions.append(
+                f"throughput: {base['throughput_turns_per_s']} -> {head['throughput_turns_per_s']} turns/s ({change:.0%})"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the agent on a fake LLM and an in-memory Elasticsearch")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="replay scripted sessions and write a report")
+    run.add_argument("--sessions", default=DEFAULT_SESSIONS, help="JSONL script or llm_play.log to replay")
+    run.add_argument("--players", type=int, default=4, help="copies of every scripted session played concurrently")
+    run.add_argument("--mode", choices=("agent", "app"), default="agent")
+    run.add_argument("--fixtures", default=DEFAULT_FIXTURES)
+    run.add_argument("--latency-scale", type=float, default=1.0)
+    run.add_argument("--port", type=int, default=8001)
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--output", help="report path, bench/results/<commit>.json by default")
+    diff = commands.add_parser("compare", help="report the regressions of a report against a baseline")
+    diff.add_argument("base")
+    diff.add_argument("head")
+    diff.add_argument("--metric", choices=("p50_ms", "p95_ms", "p99_ms"), default="p95_ms")
+    diff.add_argument("--threshold", type=float, default=0.10)
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        with open(args.base) as f:
+            base = json.load(f)
+        with open(args.head) as f:
+            head = json.load(f)
+        regressions = compare(base, head, args.metric, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if not regressions:
+            print(f"no regression above {args.threshold:.0%} between {base['commit']} and {head['commit']}")
+        sys.exit(1 if regressions else 0)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    # configured before llm_play is imported: its setup_logging is then a no-op, and the replayed
+    # turns stay out of llm_play.log, which the intent classifier mines for examples
+    setup_logging(path=os.path.join(RESULTS_DIR, "replay.log"), level="WARNING")
+    fake = FakeLLM(load_fixtures(args.fixtures), seed=args.seed, latency_scale=args.latency_scale)
+    server = serve_in_thread(fake, port=args.port)
+    # llm_play reads its endpoints and keys at import time
+    os.environ.update({
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{args.port}/v1",
+        "DEEPSEEK_BASE_URL": f"http://127.0.0.1:{args.port}",
+        "OPENAI_API_KEY": "bench",
+        "DEEPSEEK_API_KEY": "bench",
+        "DEEPSEEK_API_KEY_Villager": "bench",
+    })
+    try:
+        report = asyncio.run(run_benchmark(args, fake, InMemoryElasticsearch()))
+    finally:
+        server.should_exit = True
+    output = args.output or os.path.join(RESULTS_DIR, f"{report['commit']}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=4)
+    print_report(report)
+    print(f"report written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import asyncio
+import os
+
+from metrics import EMBED_SECONDS
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "32"))
+EMBED_MAX_WAIT_MS = float(os.getenv("EMBED_MAX_WAIT_MS", "5"))
+
+
+class EmbeddingBatcher:
+    '''
+    Collects encode requests from every session into micro-batches.
+
+    A batch is flushed to the SentenceTransformer when it reaches max_batch texts or
+    max_wait_ms after its first text arrived, whichever comes first. Encoding runs in a
+    worker thread, one batch at a time.
+    '''
+    def __init__(self, model, max_batch=EMBED_MAX_BATCH, max_wait_ms=EMBED_MAX_WAIT_MS):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.task = None
+        self.batches = 0
+        self.encoded = 0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._work())
+
+    async def encode(self, text):
+        '''
+        Embedding of one text
+        '''
+        return (await self.encode_many([text]))[0]
+
+    async def encode_many(self, texts):
+        '''
+        Embeddings of several texts, they may be split over consecutive batches
+        '''
+        loop = asyncio.get_running_loop()
+        futures = []
+        for text in texts:
+            future = loop.create_future()
+            self.queue.put_nowait((text, future))
+            futures.append(future)
+        return await asyncio.gather(*futures)
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _work(self):
+        while True:
+            batch = await self._collect()
+            # a caller may have been cancelled while waiting
+            batch = [(text, future) for text, future in batch if not future.done()]
+            if not batch:
+                continue
+            texts = [text for text, _ in batch]
+            try:
+                with EMBED_SECONDS.time():
+                    vectors = await asyncio.to_thread(
+                        self.model.encode, texts, batch_size=len(texts), show_progress_bar=False
+                    )
+            except Exception as e:
+                logger.exception("Failed to encode a batch of %d texts due to: %s", len(texts), str(e))
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.encoded += len(texts)
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "encoded": self.encoded,
+            "mean_batch_size": self.encoded / self.batches if self.batches else 0.0,
+            "queued": self.queue.qsize()
+        }
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
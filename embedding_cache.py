@@ -0,0 +1,81 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+# optional .npz file the cache is loaded from on start and saved to on shutdown
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "")
+
+
+class EmbeddingCache:
+    '''
+    Size-bounded LRU of embeddings keyed by a hash of the model name and the text,
+    so repeated summaries and queries skip the encoder
+    '''
+    def __init__(self, model_name, max_size=EMBEDDING_CACHE_SIZE, path=EMBEDDING_CACHE_PATH):
+        self.model_name = model_name
+        self.max_size = max_size
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if self.path and os.path.exists(self.path):
+            self.load()
+
+    def key(self, text):
+        # whitespace differences do not change the meaning, fold them into one entry
+        normalized = " ".join(text.split())
+        return hashlib.sha256(f"{self.model_name}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, text):
+        '''
+        Cached embedding of text, None on a miss
+        '''
+        key = self.key(text)
+        vector = self.entries.get(key)
+        if vector is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return vector
+
+    def put(self, text, vector):
+        key = self.key(text)
+        self.entries[key] = vector
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+    def load(self):
+        try:
+            data = np.load(self.path, allow_pickle=False)
+            for key, vector in zip(data["keys"], data["vectors"]):
+                self.entries[str(key)] = vector
+            logger.info("loaded %d cached embeddings from %s", len(self.entries), self.path)
+        except Exception as e:
+            logger.exception("Failed to load the embedding cache due to: %s", str(e))
+
+    def save(self):
+        if not self.path or not self.entries:
+            return
+        keys = np.array(list(self.entries.keys()))
+        vectors = np.stack(list(self.entries.values()))
+        np.savez(self.path, keys=keys, vectors=vectors)
+        logger.info("saved %d cached embeddings to %s", len(self.entries), self.path)
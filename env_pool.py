@@ -0,0 +1,154 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+from textworld import gym
+
+from metrics import ENV_POOL_READY, ENV_POOL_WAIT_SECONDS, ENV_POOL_BUILD_SECONDS, ENV_POOL_MISSES
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# envs kept built and reset ahead of the sessions asking for them, 0 builds them on demand
+ENV_POOL_SIZE = int(os.getenv("ENV_POOL_SIZE", "4"))
+# envs built concurrently by the background builders
+ENV_POOL_BUILDERS = int(os.getenv("ENV_POOL_BUILDERS", "2"))
+
+
+class EnvPool:
+    '''
+    Pre-built, pre-reset TextWorld envs of one registered game.
+
+    Background builders keep size envs ready (plus one per waiting acquire), each
+    built with gym.make and reset in a worker thread. acquire hands out a ready
+    (env, obs, infos) and only waits when the pool ran dry. A released env is reset
+    in the background and goes back to the pool, or is closed if the pool is full.
+    Resetting is much cheaper than building, so envs being reset count as coming
+    and the builders only make up for the rest.
+    '''
+    def __init__(self, env_id, size=ENV_POOL_SIZE, builders=ENV_POOL_BUILDERS):
+        self.env_id = env_id
+        self.size = size
+        self.builders = builders
+        self.ready = deque()
+        self.building = 0
+        self.resetting = 0
+        self.waiting = 0
+        self.changed = asyncio.Condition()
+        self.tasks = []
+        self.recycling = set()
+        self.counters = {"built": 0, "acquired": 0, "misses": 0, "recycled": 0, "failed": 0}
+
+    def start(self):
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self._build_loop()) for _ in range(self.builders)]
+
+    def _build(self):
+        env = gym.make(self.env_id)
+        obs, infos = env.reset()
+        return env, obs, infos
+
+    def _wanted(self):
+        return len(self.ready) + self.building + self.resetting < self.size + self.waiting
+
+    async def _build_loop(self):
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(self._wanted)
+                self.building += 1
+            started = time.monotonic()
+            try:
+                item = await asyncio.to_thread(self._build)
+            except Exception as e:
+                logger.exception("Failed to build a TextWorld env due to: %s", str(e))
+                item = None
+            ENV_POOL_BUILD_SECONDS.observe(time.monotonic() - started)
+            async with self.changed:
+                self.building -= 1
+                if item is not None:
+                    self.counters["built"] += 1
+                    self._put(item)
+                else:
+                    self.counters["failed"] += 1
+                self.changed.notify_all()
+            if item is None:
+                # do not spin on a broken game file
+                await asyncio.sleep(1)
+
+    def _put(self, item):
+        self.ready.append(item)
+        ENV_POOL_READY.set(len(self.ready))
+
+    async def acquire(self):
+        '''
+        A ready (env, obs, infos), the env is reset and owned by the caller until release
+        '''
+        started = time.monotonic()
+        async with self.changed:
+            if not self.ready:
+                self.counters["misses"] += 1
+                ENV_POOL_MISSES.inc()
+            self.waiting += 1
+            try:
+                # a waiter raises the target, wake the builders
+                self.changed.notify_all()
+                await self.changed.wait_for(lambda: self.ready)
+            finally:
+                self.waiting -= 1
+            item = self.ready.popleft()
+            ENV_POOL_READY.set(len(self.ready))
+            self.counters["acquired"] += 1
+            # the slot freed up is refilled in the background
+            self.changed.notify_all()
+        ENV_POOL_WAIT_SECONDS.observe(time.monotonic() - started)
+        return item
+
+    def release(self, env):
+        '''
+        Give an env back: it is reset in the background and reused, or closed if the pool is full
+        '''
+        self.resetting += 1
+        task = asyncio.create_task(self._recycle(env))
+        self.recycling.add(task)
+        task.add_done_callback(self.recycling.discard)
+
+    async def _recycle(self, env):
+        try:
+            obs, infos = await asyncio.to_thread(env.reset)
+        except Exception as e:
+            logger.exception("Failed to reset a released TextWorld env due to: %s", str(e))
+            obs = None
+        async with self.changed:
+            self.resetting -= 1
+            keep = obs is not None and self.tasks and self._wanted()
+            if keep:
+                self.counters["recycled"] += 1
+                self._put((env, obs, infos))
+            # either way the builders may have to make up for it
+            self.changed.notify_all()
+        if not keep:
+            await asyncio.to_thread(env.close)
+
+    def stats(self):
+        return dict(
+            self.counters,
+            size=self.size,
+            ready=len(self.ready),
+            building=self.building,
+            resetting=self.resetting,
+            waiting=self.waiting
+        )
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        # envs released by the last sessions are closed once their reset is done
+        await asyncio.gather(*self.recycling, return_exceptions=True)
+        while self.ready:
+            env, _, _ = self.ready.popleft()
+            env.close()
+        ENV_POOL_READY.set(0)
@@ -0,0 +1,54 @@
+from collections import defaultdict
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def room_from_obs(obs):
+    '''
+    Room name from the "-= Room =-" header of an observation, "" if there is no header
+    '''
+    return obs.split("-= ")[1].split(" =-")[0] if "-= " in obs and " =-" in obs else ""
+
+
+class GameState:
+    '''
+    Indexed snapshot of one TextWorld state, built once after every env.step / env.reset
+    so the prompt builders and check_win read it without rescanning the facts.
+    '''
+    def __init__(self, obs, infos):
+        self.obs = obs
+        # the inventory description of the env
+        self.inventory_text = infos.get("inventory", [])
+        # holder (container, NPC or the inventory) -> names of the items in it
+        self.container_items = defaultdict(list)
+        # lower case names of the items the player carries
+        self.inventory = set()
+        # lower case entity name -> room it is in
+        self.locations = {}
+        # lower case item name -> room it is lying in
+        self.item_rooms = {}
+        player_room = ""
+        for prop in infos.get("facts", []):
+            if prop.name == "in":
+                item, holder = prop.arguments
+                self.container_items[holder.name].append(item.name)
+                if holder.type == "I":
+                    self.inventory.add(item.name.lower())
+            elif prop.name == "at":
+                entity, room = prop.arguments
+                if entity.type == "P":
+                    player_room = room.name
+                elif room.type == "r":
+                    self.locations[entity.name.lower()] = room.name
+                    if entity.type in ("o", "k"):
+                        self.item_rooms[entity.name.lower()] = room.name
+        # the header is missing after a command that did not move or describe anything
+        self.location = room_from_obs(obs) or player_room
+
+    def items_in(self, container):
+        '''
+        Items in container as a comma separated string, "" if empty
+        '''
+        return ", ".join(self.container_items.get(container, []))
@@ -0,0 +1,173 @@
+import asyncio
+import os
+
+import numpy as np
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# most recent exchanges always replayed verbatim
+HISTORY_RECENT = int(os.getenv("HISTORY_RECENT", "4"))
+# older exchanges are folded into the rolling summary once this many are waiting
+HISTORY_FOLD_BATCH = int(os.getenv("HISTORY_FOLD_BATCH", "4"))
+# older exchanges pulled back verbatim by embedding similarity to the current input, 0 disables
+HISTORY_RELEVANT = int(os.getenv("HISTORY_RELEVANT", "2"))
+
+# prompt tokens the replayed history may take, per stage
+HISTORY_BUDGETS = {
+    "generate_dialog": int(os.getenv("HISTORY_BUDGET_DIALOG", "1500")),
+    "npc_talk": int(os.getenv("HISTORY_BUDGET_NPC", "800")),
+}
+
+
+def estimate_tokens(text):
+    # about 4 characters per token for English, close enough for a budget
+    return len(text) // 4 + 1
+
+
+def exchange_messages(exchange):
+    return [
+        {"role": "user", "content": exchange["user"]},
+        {"role": "assistant", "content": exchange["assistant"]}
+    ]
+
+
+def exchange_text(exchange):
+    return f"user: {exchange['user']}\nassistant: {exchange['assistant']}"
+
+
+class DialogHistory:
+    '''
+    Dialog of one channel (main character or an NPC) replayed under a token budget.
+
+    messages() returns the rolling summary of the folded exchanges, then up to `relevant`
+    folded exchanges most similar to the current input, then every exchange not folded yet
+    (at least the last `recent`) verbatim. Exchanges older than the last `recent` are folded
+    into the summary in the background, `fold_batch` at a time, so the summary is updated
+    incrementally off the turn's critical path; only a history over its budget is folded
+    while the turn waits. Each exchange is embedded once and its vector kept on it.
+    '''
+    def __init__(self, name, summarize=None, embed=None, recent=HISTORY_RECENT,
+                 fold_batch=HISTORY_FOLD_BATCH, relevant=HISTORY_RELEVANT):
+        '''
+        summarize: async (summary, exchanges) -> new summary, older exchanges are dropped if None
+        embed: async list of texts -> list of embeddings, needed for the relevant exchanges
+        '''
+        self.name = name
+        self.summarize = summarize
+        self.embed = embed
+        self.recent = recent
+        self.fold_batch = fold_batch
+        self.relevant = relevant
+        self.exchanges = []
+        self.summary = ""
+        # exchanges[:folded] are covered by the summary
+        self.folded = 0
+        self.folding = None
+
+    def __len__(self):
+        return len(self.exchanges)
+
+    def append(self, user, assistant):
+        self.exchanges.append({"user": user, "assistant": assistant})
+        self.maybe_fold()
+
+    def older(self):
+        '''
+        Exchanges that may be folded into the summary
+        '''
+        return self.exchanges[:max(0, len(self.exchanges) - self.recent)]
+
+    def unfolded(self):
+        '''
+        Exchanges not covered by the summary yet, always replayed verbatim
+        '''
+        return self.exchanges[self.folded:]
+
+    def maybe_fold(self):
+        if self.summarize is None:
+            # no summary: the older exchanges are dropped, only pulled back when relevant
+            self.folded = len(self.older())
+            return
+        if self.folding is not None and not self.folding.done():
+            return
+        if len(self.older()) - self.folded >= self.fold_batch:
+            self.folding = asyncio.ensure_future(self.fold())
+
+    async def fold(self, end=None):
+        '''
+        Fold the exchanges not yet in the summary up to end (the older ones by default) into it
+        '''
+        if end is None:
+            end = len(self.older())
+        pending = self.exchanges[self.folded:end]
+        try:
+            self.summary = await self.summarize(self.summary, [exchange_text(e) for e in pending])
+            self.folded = end
+            logger.info("folded %d exchanges of %s into the summary", len(pending), self.name)
+        except Exception as e:
+            logger.exception("Failed to summarize the %s history due to: %s", self.name, str(e))
+
+    async def relevant_exchanges(self, query):
+        '''
+        Folded exchanges most similar to query. Only the query and the exchanges never
+        embedded before are sent to embed, the others reuse their cached vector.
+        '''
+        candidates = self.exchanges[:self.folded]
+        if not query or not self.relevant or self.embed is None or not candidates:
+            return []
+        missing = [e for e in candidates if "vector" not in e]
+        vectors = await self.embed([query] + [exchange_text(e) for e in missing])
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        for exchange, vector in zip(missing, vectors[1:]):
+            exchange["vector"] = vector
+        scores = np.stack([e["vector"] for e in candidates]) @ vectors[0]
+        best = sorted(np.argsort(scores)[::-1][:self.relevant])
+        return [candidates[i] for i in best]
+
+    async def fold_now(self, end):
+        '''
+        Fold up to end on the caller's path, after the background fold in progress if any
+        '''
+        if self.folding is not None and not self.folding.done():
+            await self.folding
+        if end > self.folded:
+            self.folding = asyncio.ensure_future(self.fold(end))
+            await self.folding
+
+    async def messages(self, budget, query=None):
+        '''
+        History messages for a prompt, at most about budget tokens. Exchanges not covered by the
+        summary are never trimmed: past the budget they are folded into it first.
+        '''
+        relevant = await self.relevant_exchanges(query)
+
+        def fits(summary, exchanges):
+            parts = [exchange_text(e) for e in exchanges] + ([summary] if summary else [])
+            return sum(estimate_tokens(part) for part in parts) <= budget
+
+        # the relevant exchanges are already in the summary, they go first
+        while relevant and not fits(self.summary, relevant + self.unfolded()):
+            relevant = relevant[1:]
+        recent = self.unfolded()
+        if not fits(self.summary, relevant + recent) and len(recent) > 1:
+            if self.summarize is not None:
+                # keep the last exchange verbatim, the others go into the summary
+                await self.fold_now(len(self.exchanges) - 1)
+                recent = self.unfolded()
+            else:
+                # without a summary older exchanges are dropped anyway
+                while len(recent) > 1 and not fits("", relevant + recent):
+                    recent = recent[1:]
+        summary = self.summary
+        if summary and not fits(summary, relevant + recent):
+            # last resort, the summary text is still kept for the next prompts
+            summary = ""
+        messages = []
+        if summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
+        for exchange in relevant + recent:
+            messages.extend(exchange_messages(exchange))
+        return messages
@@ -0,0 +1,169 @@
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+from log_config import read_records
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# below either threshold the input goes to the initial_process LLM
+INTENT_THRESHOLD = float(os.getenv("INTENT_THRESHOLD", "0.8"))
+INTENT_MARGIN = float(os.getenv("INTENT_MARGIN", "0.05"))
+# log of earlier initial_process decisions, mined for extra labeled examples
+INTENT_LOG_PATH = os.getenv("INTENT_LOG_PATH", "llm_play.log")
+INTENT_MAX_EXAMPLES = int(os.getenv("INTENT_MAX_EXAMPLES", "200"))
+
+# labels the agent can act on without the LLM, the others only sharpen the centroids
+FAST_LABELS = ("Action", "Talk")
+
+SEED_EXAMPLES = {
+    "Action": [
+        "go north", "go south", "go east", "go west",
+        "walk to the shop", "go to the park", "head to the forest", "go back home",
+        "go to the sheriff office", "move to the school",
+        "buy rope", "buy wine", "buy some wine from the vendor", "purchase a rope",
+        "take the money", "pick up the money", "grab the knife",
+        "go down to the well", "climb down the well",
+        "give the wine to the drunker", "give the knife to the sheriff", "bring the key to the sheriff",
+        "take the money and buy rope", "go to the shop then buy wine",
+    ],
+    "Talk": [
+        "talk to the sheriff", "talk to the vendor", "talk to the drunker", "talk to the villager",
+        "ask the sheriff about the murder", "ask the vendor what he sells",
+        "tell the sheriff about the knife", "say hello to the villager",
+        "speak with the drunker", "ask the drunker what he saw that night",
+        "ask the villager what happened", "greet the vendor",
+    ],
+    "Query": [
+        "where am i", "what do i have", "what is in my inventory", "where is the sheriff",
+        "what did the sheriff tell us", "what do you know about the murder",
+        "who is the killer", "what happened last night", "what should i do next",
+    ],
+    "Chat": [
+        "hi alex", "how are you", "thank you", "who are you", "are you scared",
+        "i miss my family", "this village is creepy",
+    ],
+    "Other": [
+        "what is the weather today", "what time is it", "tell me a joke",
+        "write me a poem", "what is the capital of france", "asdfgh",
+    ],
+}
+
+NPC_NAMES = re.compile(r"\b(sheriff|vendor|drunker|drunk|villager)\b")
+# the player refers to an earlier conversation, the NPC should get the memory
+RECALL_WORDS = re.compile(r"\b(remember|told|said|earlier|before|again|last time|already)\b")
+
+USER_INPUT_LINE = re.compile(r"classify the action by user input from first process, user input: (.*)$")
+# extra fields of the one record initial_process writes per intent the LLM decided, the only
+# records mined: local decisions and fallbacks would retrain the classifier on its own predictions
+LABELED_INTENT_FIELDS = ("session_id", "user_input", "intent")
+
+# initial_process result when the LLM reply is not a valid intent
+FALLBACK_INTENT = {"status": "Other", "content": "The player's intent could not be understood"}
+
+
+def mine_log(path=INTENT_LOG_PATH, max_examples=INTENT_MAX_EXAMPLES):
+    '''
+    (user input, intent) pairs labeled by earlier initial_process LLM calls in llm_play.log.
+    Each pair comes from a single record, so the turns of concurrent sessions cannot be mixed up;
+    logs from before these records are not mined.
+    '''
+    if not path or not os.path.exists(path):
+        return []
+    examples = []
+    per_label = Counter()
+    for record in read_records(path):
+        if not all(field in record for field in LABELED_INTENT_FIELDS):
+            continue
+        user_input, label = str(record["user_input"]).strip(), record["intent"]
+        if user_input and label in SEED_EXAMPLES and per_label[label] < max_examples:
+            examples.append((user_input, label))
+            per_label[label] += 1
+    logger.info("mined %d labeled inputs from %s: %s", len(examples), path, dict(per_label))
+    return examples
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+class IntentClassifier:
+    '''
+    Nearest-centroid intent classifier over bge embeddings, the local fast path of initial_process.
+
+    Each label's centroid is the mean of its normalized example embeddings. An input is
+    labeled with the closest centroid only when the cosine similarity reaches threshold
+    and beats the runner-up by margin; otherwise classify returns None and the caller asks
+    the LLM.
+    '''
+    def __init__(self, embed_many, threshold=INTENT_THRESHOLD, margin=INTENT_MARGIN):
+        '''
+        embed_many: async callable, list of texts -> list of embeddings
+        '''
+        self.embed_many = embed_many
+        self.threshold = threshold
+        self.margin = margin
+        self.labels = []
+        self.centroids = None
+        self.hits = Counter()
+        self.fallbacks = 0
+
+    async def fit(self, examples=None):
+        '''
+        examples: (text, label) pairs, defaults to the seed examples plus the ones mined from the log
+        '''
+        if examples is None:
+            examples = [(text, label) for label, texts in SEED_EXAMPLES.items() for text in texts]
+            examples += mine_log()
+        texts = [text.lower() for text, _ in examples]
+        vectors = normalize(await self.embed_many(texts))
+        labels = sorted({label for _, label in examples})
+        centroids = [vectors[[i for i, (_, l) in enumerate(examples) if l == label]].mean(axis=0) for label in labels]
+        self.labels = labels
+        self.centroids = normalize(centroids)
+        logger.info("intent classifier fitted on %d examples, labels: %s", len(examples), labels)
+
+    async def classify(self, text):
+        '''
+        (label, score) of the closest centroid, (None, score) if not confident
+        '''
+        if self.centroids is None:
+            return None, 0.0
+        vector = normalize((await self.embed_many([text.lower()]))[0])
+        scores = self.centroids @ vector
+        order = np.argsort(scores)[::-1]
+        best = float(scores[order[0]])
+        runner_up = float(scores[order[1]]) if len(order) > 1 else -1.0
+        label = self.labels[order[0]]
+        if best < self.threshold or best - runner_up < self.margin or label not in FAST_LABELS:
+            self.fallbacks += 1
+            return None, best
+        self.hits[label] += 1
+        return label, best
+
+    @staticmethod
+    def npc_in(text):
+        '''
+        The NPC named in text, None if there is none
+        '''
+        match = NPC_NAMES.search(text.lower())
+        if match is None:
+            return None
+        return "drunker" if match.group(1) == "drunk" else match.group(1)
+
+    @staticmethod
+    def needs_memory(text):
+        return RECALL_WORDS.search(text.lower()) is not None
+
+    def stats(self):
+        answered = sum(self.hits.values())
+        return {
+            "local": dict(self.hits),
+            "fallbacks": self.fallbacks,
+            "local_rate": answered / (answered + self.fallbacks) if answered + self.fallbacks else 0.0
+        }
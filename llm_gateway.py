@@ -0,0 +1,223 @@
+import asyncio
+import os
+import random
+import time
+from collections import defaultdict, deque
+
+import httpx
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError, APITimeoutError
+
+from prompts import log_usage
+from metrics import span, LLM_SECONDS
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+# timeout of stages missing from STAGE_TIMEOUTS
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BACKOFF = float(os.getenv("LLM_RETRY_BACKOFF", "0.5"))
+# send a second request to the hedge provider once a call is slower than the stage's p95
+LLM_HEDGE = os.getenv("LLM_HEDGE", "false").lower() == "true"
+# latencies kept per stage, the p95 is only used once LLM_HEDGE_MIN_SAMPLES have been seen
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "200"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+
+# seconds, for the whole call including retries
+STAGE_TIMEOUTS = {
+    "initial_process": 15,
+    "make_action": 45,
+    "get_memory": 15,
+    "create_memory": 45,
+    "merge_memory": 30,
+    "generate_dialog": 30,
+    "get_Alex_npc": 20,
+    "npc_talk": 30,
+    "summarize_history": 30,
+}
+
+# stage -> (provider, model) the hedged request goes to. Only the DeepSeek stages are
+# hedged, their JSON mode requests are also valid on OpenAI.
+HEDGE_TARGETS = {
+    "initial_process": ("openai", "gpt-4o-mini"),
+    "get_memory": ("openai", "gpt-4o-mini"),
+    "get_Alex_npc": ("openai", "gpt-4o-mini"),
+}
+
+
+def retryable(error):
+    if isinstance(error, (APITimeoutError, APIConnectionError)):
+        return True
+    return isinstance(error, APIStatusError) and (error.status_code == 429 or error.status_code >= 500)
+
+
+class LatencyTracker:
+    def __init__(self, window=LLM_LATENCY_WINDOW):
+        self.samples = deque(maxlen=window)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, q):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class LLMGateway:
+    '''
+    Single entry point of the agent's chat completions.
+
+    The provider clients share one pooled keep-alive HTTP client. Every call gets the
+    timeout budget of its stage and is retried with exponential backoff on 429, 5xx,
+    timeouts and connection errors (the SDK's own retries are disabled). With hedging
+    on, a call slower than the p95 of its stage is raced against the same request on
+    the stage's hedge provider and the first answer wins.
+    '''
+    def __init__(self, providers, max_retries=LLM_MAX_RETRIES, hedge=LLM_HEDGE):
+        '''
+        providers: name -> {"api_key", "base_url"}
+        '''
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE,
+                keepalive_expiry=LLM_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(LLM_TIMEOUT, connect=5.0)
+        )
+        self.clients = {
+            name: AsyncOpenAI(http_client=self.http_client, max_retries=0, **settings)
+            for name, settings in providers.items()
+        }
+        self.max_retries = max_retries
+        self.hedge = hedge
+        self.latency = defaultdict(LatencyTracker)
+        self.counters = defaultdict(lambda: defaultdict(int))
+
+    async def complete(self, stage, provider, **kwargs):
+        '''
+        chat.completions.create on provider under the policy of stage. Streaming calls return
+        an async iterator of the chunks, see _stream.
+        '''
+        if kwargs.get("stream"):
+            return self._stream(stage, provider, kwargs)
+        budget = STAGE_TIMEOUTS.get(stage, LLM_TIMEOUT)
+        counters = self.counters[stage]
+        counters["calls"] += 1
+        started = time.monotonic()
+        # histogram labels, provider and model become the ones that answered once the call is done
+        labels = [stage, provider, kwargs.get("model")]
+        try:
+            with span(f"llm_{stage}", LLM_SECONDS, labels):
+                response, labels[1], labels[2] = await asyncio.wait_for(
+                    self._hedged(stage, provider, budget, kwargs), budget
+                )
+        except asyncio.TimeoutError:
+            counters["timeouts"] += 1
+            logger.warning("%s timed out after %.1fs", stage, budget)
+            raise
+        except Exception:
+            counters["errors"] += 1
+            raise
+        self.latency[stage].add(time.monotonic() - started)
+        log_usage(stage, labels[2], response.usage)
+        return response
+
+    async def _stream(self, stage, provider, kwargs):
+        '''
+        Chunks of a streaming call. The stage's budget, the span and the timeout count cover the
+        whole stream up to the last chunk, so a stalled stream is cut off; the usage chunk is logged.
+        Retried until the stream opens, never hedged.
+        '''
+        budget = STAGE_TIMEOUTS.get(stage, LLM_TIMEOUT)
+        counters = self.counters[stage]
+        counters["calls"] += 1
+        deadline = time.monotonic() + budget
+        model = kwargs.get("model")
+        try:
+            with span(f"llm_{stage}", LLM_SECONDS, (stage, provider, model)):
+                stream = await asyncio.wait_for(self._with_retries(stage, provider, budget, kwargs), budget)
+                try:
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(stream.__anext__(), deadline - time.monotonic())
+                        except StopAsyncIteration:
+                            break
+                        if chunk.usage is not None:
+                            log_usage(stage, model, chunk.usage)
+                        yield chunk
+                finally:
+                    await stream.close()
+        except asyncio.TimeoutError:
+            counters["timeouts"] += 1
+            logger.warning("%s stream timed out after %.1fs", stage, budget)
+            raise
+        except Exception:
+            counters["errors"] += 1
+            raise
+        # the stream's duration depends on the reply length, it is kept out of the hedging p95
+
+    async def _hedged(self, stage, provider, budget, kwargs):
+        '''
+        (response, provider, model) of the request that answered
+        '''
+        primary = asyncio.ensure_future(self._with_retries(stage, provider, budget, kwargs))
+        answered = {primary: (provider, kwargs.get("model"))}
+        target = HEDGE_TARGETS.get(stage)
+        tracker = self.latency[stage]
+        if not self.hedge or target is None or len(tracker.samples) < LLM_HEDGE_MIN_SAMPLES:
+            return (await primary,) + answered[primary]
+        done, _ = await asyncio.wait({primary}, timeout=tracker.percentile(0.95))
+        if done:
+            return (primary.result(),) + answered[primary]
+        hedge_provider, hedge_model = target
+        self.counters[stage]["hedges"] += 1
+        logger.info("%s slower than its p95, hedging on %s/%s", stage, hedge_provider, hedge_model)
+        hedge = asyncio.ensure_future(
+            self._with_retries(stage, hedge_provider, budget, dict(kwargs, model=hedge_model))
+        )
+        answered[hedge] = target
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.counters[stage]["hedge_wins"] += 1
+                        return (task.result(),) + answered[task]
+            # both failed, report the primary's error
+            return (primary.result(),) + answered[primary]
+        finally:
+            for task in (primary, hedge):
+                if not task.done():
+                    task.cancel()
+
+    async def _with_retries(self, stage, provider, budget, kwargs):
+        client = self.clients[provider]
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await client.chat.completions.create(timeout=budget, **kwargs)
+            except Exception as e:
+                if attempt == self.max_retries or not retryable(e):
+                    raise
+                self.counters[stage]["retries"] += 1
+                delay = LLM_RETRY_BACKOFF * 2 ** attempt * (0.5 + random.random())
+                logger.warning("%s on %s failed (%s), retry %d in %.2fs", stage, provider, str(e), attempt + 1, delay)
+                await asyncio.sleep(delay)
+
+    def stats(self):
+        stats = {}
+        for stage, counters in self.counters.items():
+            tracker = self.latency[stage]
+            stats[stage] = dict(counters, p50=tracker.percentile(0.5), p95=tracker.percentile(0.95))
+        return stats
+
+    async def close(self):
+        await self.http_client.aclose()
@@ -0,0 +1,142 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_PATH = os.getenv("LOG_PATH", "llm_play.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# per logger (stage) levels, e.g. "llm_play.memory=DEBUG,llm_gateway=WARNING"
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+# longer messages are cut, the record keeps the original length
+LOG_MAX_CHARS = int(os.getenv("LOG_MAX_CHARS", "2000"))
+# share of the verbose debug bodies (search results, queries, reasoning) that are built and logged
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.01"))
+
+# attributes of every LogRecord, anything else was passed in extra= and goes to the JSON record
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+listener = None
+
+
+def truncate(text, max_chars=LOG_MAX_CHARS):
+    if max_chars <= 0 or len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}... [{len(text) - max_chars} more chars]"
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    One JSON object per line: time, level, logger, message (truncated), the extra fields and the traceback
+    '''
+    def __init__(self, max_chars=LOG_MAX_CHARS):
+        super().__init__()
+        self.max_chars = max_chars
+
+    def format(self, record):
+        message = record.getMessage()
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": truncate(message, self.max_chars),
+        }
+        if len(message) > self.max_chars > 0:
+            entry["message_chars"] = len(message)
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class LocalQueueHandler(QueueHandler):
+    '''
+    QueueHandler that only merges the arguments into the message on the calling thread,
+    the JSON formatting and the writes happen on the listener thread
+    '''
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # the traceback cannot cross threads as live frames
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_levels(text):
+    '''
+    "llm_play.memory=DEBUG,llm_gateway=WARNING" -> {"llm_play.memory": "DEBUG", "llm_gateway": "WARNING"}
+    '''
+    levels = {}
+    for part in text.split(","):
+        name, _, level = part.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(path=LOG_PATH, level=LOG_LEVEL, levels=LOG_LEVELS):
+    '''
+    Route every record through a queue to a background thread writing JSON lines to path and stderr.
+    Logging calls then only pay for building the message. Safe to call more than once.
+    '''
+    global listener
+    if listener is not None:
+        return
+    formatter = JsonFormatter()
+    handlers = [logging.FileHandler(path), logging.StreamHandler(sys.stderr)]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [LocalQueueHandler(records)]
+    root.setLevel(level.upper())
+    for name, logger_level in parse_levels(levels).items():
+        logging.getLogger(name).setLevel(logger_level)
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+
+def sampled(logger, rate=LOG_DEBUG_SAMPLE_RATE):
+    '''
+    Whether to build and log a verbose debug body this time: logger has DEBUG enabled and the sample is drawn.
+    Guard the call with it so the body is not even formatted otherwise.
+    '''
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < rate
+
+
+def read_records(path):
+    '''
+    Records of a log written by setup_logging, as dicts with the message and the extra fields.
+    Lines that are not JSON records (plain text logs from before JSON logging) come as {"message": line}.
+    '''
+    with open(path, errors="ignore") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.startswith("{"):
+                try:
+                    record = json.loads(line)
+                    if isinstance(record, dict) and "message" in record:
+                        yield record
+                        continue
+                except ValueError:
+                    pass
+            yield {"message": line}
+
+
+def read_messages(path):
+    '''
+    Messages of a log written by setup_logging, one per record
+    '''
+    for record in read_records(path):
+        yield record["message"]
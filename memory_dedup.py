@@ -0,0 +1,59 @@
+import os
+from collections import Counter
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# cosine similarity of a new memory to its closest existing one:
+# at or above MEMORY_DUPLICATE_COSINE it is the same memory, only its timestamp is bumped,
+# below MEMORY_DISTINCT_COSINE it is a new memory, in between the LLM merges the two
+MEMORY_DUPLICATE_COSINE = float(os.getenv("MEMORY_DUPLICATE_COSINE", "0.95"))
+MEMORY_DISTINCT_COSINE = float(os.getenv("MEMORY_DISTINCT_COSINE", "0.80"))
+
+DUPLICATE = "duplicate"
+MERGE = "merge"
+DISTINCT = "distinct"
+
+
+def cosine_from_score(score):
+    '''
+    Elasticsearch reports the kNN score of a cosine dense_vector as (1 + cosine) / 2
+    '''
+    return 2 * score - 1
+
+
+class DedupPolicy:
+    '''
+    Tiered decision on what create_memory does with a new memory, by its similarity to the closest existing one
+    '''
+    def __init__(self, duplicate=MEMORY_DUPLICATE_COSINE, distinct=MEMORY_DISTINCT_COSINE):
+        if distinct > duplicate:
+            raise ValueError("MEMORY_DISTINCT_COSINE must not be above MEMORY_DUPLICATE_COSINE")
+        self.duplicate = duplicate
+        self.distinct = distinct
+        self.decisions = Counter()
+
+    def decide(self, hit):
+        '''
+        hit: the closest existing memory (kNN hit) or None
+        '''
+        if hit is None:
+            decision = DISTINCT
+        else:
+            cosine = cosine_from_score(hit["_score"])
+            if cosine >= self.duplicate:
+                decision = DUPLICATE
+            elif cosine < self.distinct:
+                decision = DISTINCT
+            else:
+                decision = MERGE
+        self.decisions[decision] += 1
+        return decision
+
+    def stats(self):
+        return {
+            "duplicate_cosine": self.duplicate,
+            "distinct_cosine": self.distinct,
+            "decisions": {decision: self.decisions[decision] for decision in (DUPLICATE, MERGE, DISTINCT)}
+        }
@@ -0,0 +1,90 @@
+import asyncio
+import os
+from collections import defaultdict
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+MEMORY_QUEUE_SIZE = int(os.getenv("MEMORY_QUEUE_SIZE", "256"))
+MEMORY_WRITERS = int(os.getenv("MEMORY_WRITERS", "4"))
+
+
+class MemoryWriter:
+    '''
+    Write-behind queue for create_memory.
+
+    Chat turns submit their conversation and return immediately, worker tasks ingest it
+    afterwards. The queue is bounded, so submit waits (back-pressure) when the writers
+    fall behind. Writes of one session are applied in order, and flush(session_id) waits
+    until the writes submitted by that session have landed, which gives the next
+    get_memory of the session read-your-writes. Every submit gets an increasing ticket,
+    flush(session_id, upto=ticket) only waits for the writes up to that ticket so a turn
+    does not wait on the memories it queued itself.
+    '''
+    def __init__(self, maxsize=MEMORY_QUEUE_SIZE, workers=MEMORY_WRITERS):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.workers = workers
+        self.outstanding = defaultdict(set)
+        self.next_ticket = 0
+        self.session_locks = defaultdict(asyncio.Lock)
+        self.drained = asyncio.Condition()
+        self.tasks = []
+
+    def start(self):
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def submit(self, agent, conversation):
+        '''
+        Queue a conversation to be turned into memories for the agent's session
+        '''
+        ticket = self.next_ticket
+        self.next_ticket += 1
+        self.outstanding[agent.session_id].add(ticket)
+        await self.queue.put((ticket, agent, conversation))
+        return ticket
+
+    def last_ticket(self):
+        '''
+        Ticket of the most recent submit, pass it to flush as a barrier
+        '''
+        return self.next_ticket - 1
+
+    async def flush(self, session_id, upto=None):
+        '''
+        Wait until the memory writes queued by session_id (up to ticket upto, all if None) have been applied
+        '''
+        def done():
+            tickets = self.outstanding.get(session_id, ())
+            return not any(upto is None or ticket <= upto for ticket in tickets)
+        async with self.drained:
+            await self.drained.wait_for(done)
+
+    async def _work(self):
+        while True:
+            ticket, agent, conversation = await self.queue.get()
+            session_id = agent.session_id
+            try:
+                async with self.session_locks[session_id]:
+                    await agent.create_memory(conversation)
+            except Exception as e:
+                logger.exception("Failed to create memory due to: %s", str(e))
+            finally:
+                self.queue.task_done()
+                async with self.drained:
+                    self.outstanding[session_id].discard(ticket)
+                    if not self.outstanding[session_id]:
+                        del self.outstanding[session_id]
+                        self.session_locks.pop(session_id, None)
+                    self.drained.notify_all()
+
+    async def close(self):
+        '''
+        Drain the queue, then stop the workers
+        '''
+        if self.tasks:
+            await self.queue.join()
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
@@ -0,0 +1,162 @@
+import asyncio
+import contextvars
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# threads of the default executor (embedding batches, env creation), same default as asyncio
+THREADPOOL_WORKERS = int(os.getenv("THREADPOOL_WORKERS", str(min(32, (os.cpu_count() or 1) + 4))))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+
+STAGE_SECONDS = Histogram(
+    "agent_stage_seconds", "Duration of the stages of a turn", ["stage"], buckets=LATENCY_BUCKETS
+)
+TURN_SECONDS = Histogram(
+    "agent_turn_seconds", "Duration of a whole main_process turn", buckets=LATENCY_BUCKETS
+)
+LLM_SECONDS = Histogram(
+    "llm_call_seconds", "Duration of a chat completion call, retries and hedging included",
+    ["stage", "provider", "model"], buckets=LATENCY_BUCKETS
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total", "Tokens reported by the LLM providers", ["stage", "model", "kind"]
+)
+ES_SECONDS = Histogram(
+    "es_request_seconds", "Duration of an Elasticsearch request", ["operation"], buckets=LATENCY_BUCKETS
+)
+EMBED_SECONDS = Histogram(
+    "embed_batch_seconds", "Duration of the encoding of one embedding micro-batch", buckets=LATENCY_BUCKETS
+)
+THREADPOOL_SIZE = Gauge("threadpool_workers", "Threads of the default executor")
+THREADPOOL_ACTIVE = Gauge("threadpool_active", "Default executor jobs running")
+THREADPOOL_QUEUED = Gauge("threadpool_queued", "Default executor jobs waiting for a free thread")
+EVENT_LOOP_LAG = Gauge("event_loop_lag_seconds", "Lateness of a periodic event loop callback, last sample")
+ENV_POOL_READY = Gauge("env_pool_ready", "TextWorld envs built, reset and waiting for a session")
+ENV_POOL_WAIT_SECONDS = Histogram(
+    "env_pool_wait_seconds", "Time a session start or reset waited for a ready TextWorld env", buckets=LATENCY_BUCKETS
+)
+ENV_POOL_BUILD_SECONDS = Histogram(
+    "env_pool_build_seconds", "Duration of gym.make and reset of a pooled TextWorld env", buckets=LATENCY_BUCKETS
+)
+ENV_POOL_MISSES = Counter("env_pool_misses_total", "Env acquires that found the pool empty")
+
+# spans of the turn in progress in the current task, None outside a turn
+current_spans = contextvars.ContextVar("current_spans", default=None)
+
+
+@contextmanager
+def span(stage, histogram=STAGE_SECONDS, labels=None):
+    '''
+    Time a block: observed in histogram (agent_stage_seconds labeled with the stage by default)
+    and appended to the span list of the turn in progress
+    '''
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        histogram.labels(*(labels or (stage,))).observe(elapsed)
+        spans = current_spans.get()
+        if spans is not None:
+            spans.append((stage, elapsed))
+
+
+def traced(stage):
+    '''
+    Decorator running an async method in a span
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            with span(stage):
+                return await method(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def turn_spans():
+    '''
+    Collect the spans of one turn (including the ones of its child tasks), yields the list.
+    Nested collections also hand their spans to the enclosing one, see bench/replay.py
+    '''
+    outer = current_spans.get()
+    spans = []
+    token = current_spans.set(spans)
+    try:
+        yield spans
+    finally:
+        current_spans.reset(token)
+        if outer is not None:
+            outer.extend(spans)
+
+
+def format_spans(spans):
+    return ", ".join(f"{stage} {elapsed * 1000:.0f}ms" for stage, elapsed in spans)
+
+
+def timed_es(operation):
+    '''
+    Decorator running an async Elasticsearch call in a span observed in es_request_seconds
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            with span(f"es_{operation}", ES_SECONDS, (operation,)):
+                return await method(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_usage(stage, model, prompt_tokens, completion_tokens, cached_tokens):
+    LLM_TOKENS.labels(stage, model, "prompt").inc(prompt_tokens)
+    LLM_TOKENS.labels(stage, model, "completion").inc(completion_tokens)
+    LLM_TOKENS.labels(stage, model, "cached").inc(cached_tokens)
+
+
+class TrackedExecutor(ThreadPoolExecutor):
+    '''
+    Default executor reporting its running and waiting jobs, a growing queue means the pool is exhausted
+    '''
+    def __init__(self, max_workers=THREADPOOL_WORKERS):
+        super().__init__(max_workers=max_workers)
+        THREADPOOL_SIZE.set(max_workers)
+
+    def submit(self, fn, *args, **kwargs):
+        THREADPOOL_QUEUED.inc()
+
+        def run():
+            THREADPOOL_QUEUED.dec()
+            THREADPOOL_ACTIVE.inc()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                THREADPOOL_ACTIVE.dec()
+        return super().submit(run)
+
+
+async def monitor_event_loop(interval=1.0):
+    '''
+    Sample how late the loop wakes up from a sleep, a busy or blocked loop delays every request
+    '''
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.set(max(0.0, loop.time() - started - interval))
+
+
+def exposition():
+    '''
+    (body, content type) of the Prometheus text exposition of every metric
+    '''
+    return generate_latest(), CONTENT_TYPE_LATEST
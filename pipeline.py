@@ -0,0 +1,59 @@
+import asyncio
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Pipeline:
+    '''
+    Small dependency graph of the async stages of a turn.
+
+    Every stage starts as soon as the stages it depends on have finished, so independent
+    LLM calls run concurrently and the turn takes as long as its critical path. A stage
+    is a coroutine function called with the results of its dependencies, in order.
+    '''
+    def __init__(self, name="turn"):
+        self.name = name
+        self.stages = {}
+        # stage -> (start, end) in seconds since run() started
+        self.timings = {}
+
+    def add(self, name, fn, deps=()):
+        '''
+        Add stage name, its dependencies must have been added before
+        '''
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"stage {name} depends on unknown stage {dep}")
+        self.stages[name] = (fn, tuple(deps))
+        return self
+
+    async def run(self):
+        '''
+        Run every stage, returns {stage: result}. The first failure cancels the remaining stages.
+        '''
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        tasks = {}
+
+        async def run_stage(name, fn, deps):
+            args = [await tasks[dep] for dep in deps]
+            begin = loop.time() - started
+            result = await fn(*args)
+            self.timings[name] = (begin, loop.time() - started)
+            return result
+
+        for name, (fn, deps) in self.stages.items():
+            tasks[name] = asyncio.ensure_future(run_stage(name, fn, deps))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+        logger.info(
+            "%s pipeline finished in %.2fs: %s", self.name, loop.time() - started,
+            ", ".join(f"{name} {begin:.2f}-{end:.2f}s" for name, (begin, end) in self.timings.items())
+        )
+        return {name: task.result() for name, task in tasks.items()}
@@ -0,0 +1,237 @@
+import json
+import re
+from collections import deque
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+GAME_JSON = "./textworld_map/village_game.json"
+
+# (fact name, direction from the second room to the first one)
+DIRECTION_FACTS = {
+    "north_of": "north",
+    "south_of": "south",
+    "east_of": "east",
+    "west_of": "west",
+}
+OPPOSITE = {"north": "south", "south": "north", "east": "west", "west": "east"}
+
+# NPCs that are not compiled into the game file
+EXTRA_LOCATIONS = {
+    "villager": "House",
+}
+
+# extra names the player uses for places, NPCs and containers map to their room
+ROOM_ALIASES = {
+    "store": "Shop",
+    "park": "Center Park",
+    "centre park": "Center Park",
+    "committee": "Village Committee",
+    "sheriff's office": "Sheriff Office",
+    "sheriffs office": "Sheriff Office",
+    "police": "Sheriff Office",
+    "police station": "Sheriff Office",
+    "house 1": "Home",
+    "house 2": "House",
+    "woods": "Forest",
+}
+
+FILLER = re.compile(
+    r"^(?:please |alex,? |ok,? |okay,? |now |let'?s |let us |i want (?:you )?to |i need (?:you )?to |can you |could you |you should |we should |we need to |need to |try to )+"
+)
+ARTICLE = r"(?:(?:a|an|the|some|my|our) )?"
+
+RULES = [
+    ("move", re.compile(r"^(?:go|walk|move|head|run)(?: to(?: the)?)? (north|south|east|west)$")),
+    ("goto", re.compile(r"^(?:go|walk|move|head|run|travel|return|come)(?: back)?(?: over)? to " + ARTICLE + r"(.+)$")),
+    ("buy", re.compile(r"^(?:buy|purchase) " + ARTICLE + r"(\w+)(?: from " + ARTICLE + r"(?:vendor|shop|store))?$")),
+    ("well", re.compile(r"^(?:go |climb |get )?down (?:to |into |in )?" + ARTICLE + r"well$")),
+    ("give", re.compile(r"^(?:give|bring|hand|deliver) " + ARTICLE + r"(\w+) to " + ARTICLE + r"(\w+)$")),
+    ("take", re.compile(r"^(?:take|pick up|get|grab) " + ARTICLE + r"(\w+)$")),
+]
+
+
+class CommandPlanner:
+    '''
+    Deterministic replacement for the make_action LLM call.
+
+    The room graph is read from the compiled game description, paths are found by BFS
+    and the special commands (buy <item>, down to well, give <item> to <npc>) are
+    expanded from a rule table. plan() returns None when the intent does not parse,
+    the caller then falls back to the LLM.
+    '''
+    def __init__(self, edges, locations):
+        # room -> {direction: room}
+        self.edges = edges
+        # lower case npc / container / item name -> room at game start
+        self.locations = locations
+        self.rooms = {room.lower(): room for room in edges}
+
+    @classmethod
+    def from_game_json(cls, path=GAME_JSON):
+        with open(path) as f:
+            game = json.load(f)
+        names = {entity_id: info["name"] for entity_id, info in game["infos"]}
+        edges = {}
+        locations = dict(EXTRA_LOCATIONS)
+        for fact in game["world"]:
+            args = [arg["name"] for arg in fact["arguments"]]
+            if fact["name"] in DIRECTION_FACTS:
+                # north_of(a, b): a is north of b
+                a, b = names[args[0]], names[args[1]]
+                direction = DIRECTION_FACTS[fact["name"]]
+                edges.setdefault(b, {})[direction] = a
+                edges.setdefault(a, {})[OPPOSITE[direction]] = b
+            elif fact["name"] == "at" and fact["arguments"][0]["type"] != "P":
+                locations[names[args[0]].lower()] = names[args[1]]
+        return cls(edges, locations)
+
+    def path(self, start, goal):
+        '''
+        Shortest list of "go <dir>" commands from start to goal, None if unreachable
+        '''
+        if start == goal:
+            return []
+        previous = {start: None}
+        queue = deque([start])
+        while queue:
+            room = queue.popleft()
+            for direction, neighbour in self.edges.get(room, {}).items():
+                if neighbour in previous:
+                    continue
+                previous[neighbour] = (room, direction)
+                if neighbour == goal:
+                    commands = []
+                    while previous[neighbour] is not None:
+                        neighbour, direction = previous[neighbour]
+                        commands.append(f"go {direction}")
+                    return commands[::-1]
+                queue.append(neighbour)
+        return None
+
+    def resolve_room(self, name, item_rooms=None):
+        '''
+        Room for a room name, alias, NPC, container or item; None if unknown
+        '''
+        name = name.strip().lower()
+        if name in self.rooms:
+            return self.rooms[name]
+        if name in ROOM_ALIASES:
+            return ROOM_ALIASES[name]
+        if item_rooms and name in item_rooms:
+            return item_rooms[name]
+        return self.locations.get(name)
+
+    def split_clauses(self, text):
+        text = text.lower().strip()
+        text = re.sub(r"[.!?\"]", "", text)
+        clauses = re.split(r",? and then |,? then |,? and |, |; ", text)
+        return [FILLER.sub("", clause.strip()) for clause in clauses if clause.strip()]
+
+    def plan(self, text, location, inventory, item_rooms=None):
+        '''
+        text: the action description from initial_process
+        location: current room
+        inventory: set of lower case item names carried
+        item_rooms: lower case item name -> room, for items lying in a room
+        Returns {"status", "npc", "content"} like the LLM planner, or None if ambiguous.
+        A request that is already satisfied (going to the current room) is approved with no commands.
+        '''
+        clauses = self.split_clauses(text)
+        if not clauses:
+            return None
+        parsed = []
+        for clause in clauses:
+            for kind, pattern in RULES:
+                match = pattern.match(clause)
+                if match:
+                    parsed.append((kind, match.groups()))
+                    break
+            else:
+                logger.info("planner cannot parse %r, falling back to the LLM", clause)
+                return None
+
+        inventory = set(inventory)
+        commands = []
+        npc = "None"
+
+        def walk_to(room):
+            nonlocal location
+            steps = self.path(location, room)
+            if steps is None:
+                return False
+            commands.extend(steps)
+            location = room
+            return True
+
+        for kind, groups in parsed:
+            if kind == "move":
+                target = self.edges.get(location, {}).get(groups[0])
+                if target is None:
+                    return self.rejected()
+                commands.append(f"go {groups[0]}")
+                location = target
+            elif kind == "goto":
+                room = self.resolve_room(groups[0], item_rooms)
+                if room is None:
+                    return None
+                if not walk_to(room):
+                    return None
+            elif kind == "buy":
+                item = groups[0]
+                if "money" not in inventory or item not in ("rope", "wine"):
+                    return self.rejected()
+                if not walk_to(self.locations["vendor"]):
+                    return None
+                commands.extend([
+                    "unlock vendor with money",
+                    "open vendor",
+                    f"take {item} from vendor",
+                    "insert money into vendor",
+                    "close vendor",
+                ])
+                inventory.discard("money")
+                inventory.add(item)
+                npc = "Vendor"
+            elif kind == "well":
+                if "rope" not in inventory:
+                    return self.rejected()
+                if not walk_to(self.locations["well"]):
+                    return None
+                commands.extend(["insert rope into well", "take knife from well"])
+                inventory.discard("rope")
+                inventory.add("knife")
+            elif kind == "give":
+                item, target = groups
+                room = self.locations.get(target)
+                if room is None:
+                    return None
+                if item not in inventory:
+                    return self.rejected()
+                if not walk_to(room):
+                    return None
+                if target == "drunker":
+                    commands.extend([f"unlock Drunker with {item}", "open Drunker", f"insert {item} into Drunker"])
+                else:
+                    commands.append(f"insert {item} into {target}")
+                inventory.discard(item)
+                npc = target.capitalize()
+            elif kind == "take":
+                item = groups[0]
+                room = (item_rooms or {}).get(item)
+                if room is None:
+                    # not lying around, let the LLM work out where it comes from
+                    return None
+                if not walk_to(room):
+                    return None
+                commands.append(f"take {item}")
+                inventory.add(item)
+
+        if not commands:
+            logger.info("planner: %r needs no command, the player is already there", text)
+        return {"status": "approved", "npc": npc, "content": commands}
+
+    @staticmethod
+    def rejected():
+        return {"status": "rejected", "npc": "None", "content": ["reject command"]}
@@ -0,0 +1,125 @@
+import copy
+from functools import lru_cache
+from typing import List, Literal, Optional, Union
+
+from pydantic import BaseModel, create_model, model_validator
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+Character = Literal["player", "vendor", "sheriff", "drunker", "villager", "alex", "unknown"]
+MemoryType = Literal["event", "thought", "observation", "dialogue", "perception", "fact", "goal", "preference", "unknown"]
+
+
+class QueryContent(BaseModel):
+    question: str
+    memory: bool
+    memory_query: str
+
+
+class TalkContent(BaseModel):
+    npc: str
+    dialog: str
+    memory: bool
+    memory_query: str
+
+
+class Intent(BaseModel):
+    '''
+    initial_process: the player's intent and its content
+    '''
+    status: Literal["Action", "Query", "Talk", "Chat", "Other"]
+    content: Union[TalkContent, QueryContent, str]
+
+    @model_validator(mode="after")
+    def check_content(self):
+        expected = {"Query": QueryContent, "Talk": TalkContent}.get(self.status, str)
+        if not isinstance(self.content, expected):
+            raise ValueError(f"the content of a {self.status} intent must be a {expected.__name__}")
+        return self
+
+
+class ActionPlan(BaseModel):
+    '''
+    make_action: the TextWorld commands to execute, same shape as CommandPlanner.plan
+    '''
+    status: Literal["approved", "rejected", "confused"]
+    npc: str
+    content: List[str]
+
+
+class MemoryQuery(BaseModel):
+    '''
+    get_memory: filters, boosting keywords and the sentence to embed for the kNN search
+    '''
+    character: Optional[Character]
+    memory_type: Optional[MemoryType]
+    keywords: List[str]
+    word_need_embed: str
+
+
+class MemoryRecord(BaseModel):
+    character: Character
+    memory_type: MemoryType
+    summary: str
+    raw_input: str
+    keywords: List[str]
+
+
+class NewMemories(BaseModel):
+    '''
+    create_memory: the memories to insert, empty if the conversation has nothing worth keeping
+    '''
+    insert_memory: List[MemoryRecord]
+
+
+class MemoryUpdate(BaseModel):
+    '''
+    merge_memory: the merged summary and whether the old memory is superseded
+    '''
+    new_memory: str
+    delete_memory: bool
+
+
+@lru_cache(maxsize=None)
+def with_reasoning(schema):
+    '''
+    Debug variant of schema: {"reasoning": [...], "answer": <schema>}, reasoning comes first so the
+    model writes it before the answer
+    '''
+    return create_model(f"{schema.__name__}WithReasoning", reasoning=(List[str], ...), answer=(schema, ...))
+
+
+def strict_json_schema(schema):
+    '''
+    JSON schema of a pydantic model in the subset accepted by OpenAI strict structured outputs:
+    every object closes additionalProperties and lists all its properties as required
+    '''
+    def close(node):
+        if isinstance(node, dict):
+            node.pop("title", None)
+            node.pop("default", None)
+            if node.get("type") == "object" and "properties" in node:
+                node["additionalProperties"] = False
+                node["required"] = list(node["properties"])
+            for value in node.values():
+                close(value)
+        elif isinstance(node, list):
+            for value in node:
+                close(value)
+        return node
+    return close(copy.deepcopy(schema.model_json_schema()))
+
+
+def response_format(schema, strict=True):
+    '''
+    response_format argument of chat.completions.create.
+    strict: JSON-schema structured outputs (OpenAI), otherwise plain JSON mode (DeepSeek)
+    '''
+    if not strict:
+        return {"type": "json_object"}
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": schema.__name__, "schema": strict_json_schema(schema), "strict": True}
+    }
@@ -0,0 +1,190 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from llm_play import LLM_Agent, AgentResources
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "200"))
+SESSION_IDLE_TIMEOUT = float(os.getenv("SESSION_IDLE_TIMEOUT", "1800"))
+
+
+class SessionPoolFull(Exception):
+    '''
+    Raised when every slot of the pool is held by a busy session
+    '''
+
+
+class Session:
+    def __init__(self, session_id, agent):
+        self.session_id = session_id
+        self.agent = agent
+        # serialize the turns of one player, different players run in parallel
+        self.lock = asyncio.Lock()
+        # turns started and not finished, running or waiting for the lock
+        self.turns = 0
+        self.last_seen = time.monotonic()
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    def idle_for(self):
+        return time.monotonic() - self.last_seen
+
+    def busy(self):
+        return self.turns > 0 or self.lock.locked()
+
+    def turn(self):
+        '''
+        Context manager holding the lock for one turn. The session is busy from this call on,
+        also while the turn waits for the lock, so it cannot be evicted before the turn runs.
+        '''
+        self.turns += 1
+        return self._turn()
+
+    @asynccontextmanager
+    async def _turn(self):
+        try:
+            async with self.lock:
+                yield self.agent
+        finally:
+            self.turns -= 1
+
+
+class SessionManager:
+    '''
+    Keeps one LLM_Agent (env, obs/infos, dialog history, chat round) per session id.
+    The pool is bounded by max_sessions, least recently used idle sessions are evicted
+    first, and sessions idle longer than idle_timeout are dropped by evict_idle.
+    '''
+    def __init__(self, resources=None, max_sessions=MAX_SESSIONS, idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.resources = resources if resources is not None else AgentResources()
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = OrderedDict()
+        # session id -> future of the session being created, each one holds a slot of the pool
+        self.creating = {}
+        self._lock = asyncio.Lock()
+
+    async def initialize(self):
+        await self.resources.initialize()
+
+    async def get(self, session_id):
+        '''
+        Return the session for session_id, creating it if needed
+        '''
+        evicted = None
+        async with self._lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                self.sessions.move_to_end(session_id)
+                session.touch()
+                return session
+            creating = self.creating.get(session_id)
+            if creating is None:
+                # reserve the slot before the slow build, concurrent creators count against the bound
+                if len(self.sessions) + len(self.creating) >= self.max_sessions:
+                    evicted = self._evict_lru()
+                creating = self.creating[session_id] = asyncio.get_running_loop().create_future()
+                creator = True
+            else:
+                creator = False
+        if not creator:
+            # another request is creating this session, share its result
+            return await asyncio.shield(creating)
+        if evicted is not None:
+            await self._forget(evicted)
+        try:
+            session = await self._create(session_id)
+        except BaseException as e:
+            async with self._lock:
+                del self.creating[session_id]
+            self._fail(creating, e)
+            raise
+        evicted = []
+        async with self._lock:
+            del self.creating[session_id]
+            try:
+                # the slot was reserved, never go over the bound on insert anyway
+                while len(self.sessions) + len(self.creating) >= self.max_sessions:
+                    evicted.append(self._evict_lru())
+            except SessionPoolFull as e:
+                session.agent.close()
+                self._fail(creating, e)
+                raise
+            self.sessions[session_id] = session
+        creating.set_result(session)
+        for old in evicted:
+            await self._forget(old)
+        logger.info("created session %s (%d active)", session_id, len(self.sessions))
+        return session
+
+    @staticmethod
+    def _fail(creating, error):
+        creating.set_exception(error)
+        # mark it retrieved, there may be no other request waiting for it
+        creating.exception()
+
+    async def _create(self, session_id):
+        # a pre-built, pre-reset env from the pool, waited for outside the manager lock
+        ready_env = await self.resources.env_pool.acquire()
+        try:
+            agent = LLM_Agent(self.resources, session_id, ready_env=ready_env)
+        except BaseException:
+            self.resources.env_pool.release(ready_env[0])
+            raise
+        session = Session(session_id, agent)
+        # memories left under this id by an earlier server process belong to a game that is gone,
+        # a failed delete is logged and the session starts anyway
+        try:
+            await self._forget(session)
+        except BaseException:
+            agent.close()
+            raise
+        return session
+
+    def _evict_lru(self):
+        for session_id, session in self.sessions.items():
+            if not session.busy():
+                return self._drop(session_id)
+        raise SessionPoolFull(f"all {self.max_sessions} sessions are busy")
+
+    def _drop(self, session_id):
+        session = self.sessions.pop(session_id)
+        session.agent.close()
+        logger.info("evicted session %s", session_id)
+        return session
+
+    async def _forget(self, session):
+        '''
+        Delete the memories of a session, failures are logged
+        '''
+        try:
+            await session.agent.forget()
+        except Exception as e:
+            logger.exception("Failed to delete the memories of session %s due to: %s", session.session_id, str(e))
+
+    async def evict_idle(self):
+        '''
+        Drop every session that has been idle for longer than idle_timeout
+        '''
+        async with self._lock:
+            expired = [
+                session_id for session_id, session in self.sessions.items()
+                if session.idle_for() > self.idle_timeout and not session.busy()
+            ]
+            evicted = [self._drop(session_id) for session_id in expired]
+        for session in evicted:
+            await self._forget(session)
+        return len(evicted)
+
+    async def close(self):
+        async with self._lock:
+            for session_id in list(self.sessions):
+                self._drop(session_id)
+        await self.resources.close()
@@ -0,0 +1,40 @@
+import asyncio
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TurnContext:
+    '''
+    Memo of the lookups made during one main_process call.
+
+    Async lookups (memory retrieval, embeddings) are stored as tasks, so a second caller
+    asking for the same key while the first is still running awaits the same result.
+    Game state projections are indexed once per env step by GameState instead.
+    '''
+    def __init__(self):
+        self.tasks = {}
+        self.lookups = 0
+        self.reused = 0
+
+    async def memo(self, key, factory):
+        '''
+        Result of the coroutine factory() for key, computed once per turn
+        '''
+        self.lookups += 1
+        task = self.tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self.tasks[key] = task
+        else:
+            self.reused += 1
+        # a cancelled caller must not cancel the lookup others are waiting on
+        return await asyncio.shield(task)
+
+    def close(self):
+        for task in self.tasks.values():
+            if not task.done():
+                task.cancel()
+        logger.info("turn finished: %d lookups, %d reused", self.lookups, self.reused)
+
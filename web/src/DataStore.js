@@ -1,10 +1,16 @@
 import { defineStore } from 'pinia'
 import axios from 'axios'
 
+// one game session per browser tab, the backend keys the player's game by this id
+const sessionId = sessionStorage.getItem('sessionId') || crypto.randomUUID()
+sessionStorage.setItem('sessionId', sessionId)
+axios.defaults.headers.common['X-Session-Id'] = sessionId
+
 export const useDataStore = defineStore('DataStore', {
   state: () => ({
     currentLocation: 'Home',
     currentWindow: 'GameFlow',
+    sessionId: sessionId,
   }),
   actions: {
     setCurrentLocation(location) {